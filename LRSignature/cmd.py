@@ -6,6 +6,9 @@ Created on Jun 14, 2011
 import types
 import sys
 
+# envelopes held in memory at a time when streaming
+BATCH_SIZE = 100
+
 class InvalidJSONError(ValueError):
     def __init__(self, msg):
         ValueError.__init__(self)
@@ -26,30 +29,136 @@ class PipeTool(object):
 
         import json
 
-        rawInput = self.readInput()
-        envelopeList = self.parseInput(rawInput)
-
         if self.args.mode == "sign":
             self.signtool = Sign_0_21(privateKeyID=self.args.key,
                               passphrase=self.args.passphrase,
                               gnupgHome=self.args.gnupghome,
                               gpgbin=self.args.gpgbin, publicKeyLocations=self.args.key_location)
 
+        elif self.args.mode == "verify":
+            cache = None
+            if self.args.cache != None:
+                from LRSignature.verify.cache import VerifyCache
+                cache = VerifyCache(self.args.cache)
+            self.verifytool = Verify_0_21(gpgbin=self.args.gpgbin, gnupgHome=self.args.gnupghome, cache=cache)
+            from LRSignature.util.keys import KeyResolver
+            self.keyResolver = KeyResolver(self.verifytool.gpg, cacheDir=self.args.key_cache, ttl=self.args.key_cache_ttl)
+
+            if self.args.harvest_url != None:
+                self.runHarvest()
+                return
+
+        if self.args.ndjson:
+            self.runNdjson()
+            return
+
+        envelopes = self.parseStream(sys.stdin)
+
+        if self.args.mode == "sign":
             is_test_data_opt = self.args.lr_test_data.lower() in ["true", "yes", "t", "y"]
 
-            signedList = self.signEnvelopes(envelopeList, is_test_data=is_test_data_opt)
+            signed = self._signStream(envelopes, is_test_data=is_test_data_opt)
 
             if self.args.publish_url != None:
-                self.publishEnvelopes(signedList)
+                self.publishEnvelopes(signed)
             else:
-                print json.dumps({ "documents": signedList })
+                # same output as json.dumps({ "documents": signedList }), written as it is signed
+                sys.stdout.write('{"documents": [')
+                for idx, envelope in enumerate(signed):
+                    if idx > 0:
+                        sys.stdout.write(', ')
+                    sys.stdout.write(json.dumps(envelope))
+                sys.stdout.write(']}\n')
 
         elif self.args.mode == "verify":
-            self.verifytool = Verify_0_21(gpgbin=self.args.gpgbin, gnupgHome=self.args.gnupghome)
-            resultList = self.validateEnvelopes(envelopeList)
+            resultList = []
+            for chunk in self._chunkStream(envelopes, BATCH_SIZE):
+                resultList.extend(self.validateEnvelopes(chunk, workers=self.args.workers))
             print json.dumps({"results": resultList})
 
+    def _signStream(self, envelopes, is_test_data=True):
+        for chunk in self._chunkStream(envelopes, BATCH_SIZE):
+            for signed in self.signEnvelopes(chunk, is_test_data=is_test_data):
+                yield signed
 
+    def runNdjson(self):
+        '''
+        Streams newline delimited JSON: every input line holds one envelope (or
+        any other input format parseInput accepts), every output line one signed
+        envelope, verification result or publish status. Only BATCH_SIZE
+        envelopes are held at a time.
+        '''
+        envelopes = self._readNdjson()
+
+        if self.args.mode == "sign":
+            is_test_data_opt = self.args.lr_test_data.lower() in ["true", "yes", "t", "y"]
+
+            if self.args.publish_url != None:
+                for status in self._publishStream(self._signStream(envelopes, is_test_data=is_test_data_opt)):
+                    self._writeLines([status])
+            else:
+                for chunk in self._chunkStream(envelopes, BATCH_SIZE):
+                    self._writeLines(self.signEnvelopes(chunk, is_test_data=is_test_data_opt))
+
+        elif self.args.mode == "verify":
+            for chunk in self._chunkStream(envelopes, BATCH_SIZE):
+                self._writeLines(self.validateEnvelopes(chunk, workers=self.args.workers))
+
+    def runHarvest(self):
+        '''
+        Verifies every record a node returns from harvest/listrecords, page by
+        page, writing the results of each page before the next is verified.
+        With --harvest-checkpoint an interrupted audit picks up after the last
+        page whose results were written.
+        '''
+        import json
+        from LRSignature.util.harvest import ListRecordsHarvest
+
+        harvest = ListRecordsHarvest(self.args.harvest_url,
+                                     checkpointPath=self.args.harvest_checkpoint,
+                                     timeout=self.args.harvest_timeout)
+
+        if not self.args.ndjson:
+            sys.stdout.write('{"results": [')
+        written = 0
+        for records in harvest.pages():
+            for chunk in self._chunkStream(records, BATCH_SIZE):
+                results = self.validateEnvelopes(chunk, workers=self.args.workers)
+                if self.args.ndjson:
+                    self._writeLines(results)
+                    continue
+                for result in results:
+                    if written > 0:
+                        sys.stdout.write(', ')
+                    sys.stdout.write(json.dumps(result))
+                    written += 1
+                sys.stdout.flush()
+        if not self.args.ndjson:
+            sys.stdout.write(']}\n')
+
+    def _readNdjson(self):
+        for line in iter(sys.stdin.readline, ""):
+            if len(line.strip()) == 0:
+                continue
+            for envelope in self.parseInput(line):
+                yield envelope
+
+    def _writeLines(self, objs):
+        import json
+        for obj in objs:
+            sys.stdout.write(json.dumps(obj))
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def _chunkStream(self, stream, chunkSize=10):
+        chunk = []
+        for item in stream:
+            chunk.append(item)
+            if len(chunk) >= chunkSize:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
 
 
     def _set_test_key(self, envelope, remove=True):
@@ -71,17 +180,7 @@ class PipeTool(object):
 
         return envelope
 
-    def _chunkList(self, fullList = [], chunkSize=10):
-        numElements = len(fullList)
-        for start in range(0, numElements, chunkSize):
-            end = start+chunkSize
-            if end > numElements:
-                end = numElements
-            yield fullList[start:end]
-
-
-    def _validate_digital_signature(self, doc):
-        from LRSignature import util
+    def _validate_digital_signature(self, doc, missingKeys=None):
         from LRSignature import errors
 
 
@@ -97,14 +196,12 @@ class PipeTool(object):
 
         except errors.MissingPublicKey:
 
-            locations = doc['digital_signature']['key_location']
-            numImported = 0
-            for location in locations:
-                rawKeys = util.fetchkeys(location)
-                for rawKey in rawKeys:
-                    numImported += util.storekey(self.sampleKey, gpgbin=self.args.gpgbin, gnupgHome=self.args.gnupghome)
-                if numImported > 0:
-                    break
+            if missingKeys is not None:
+                # validateEnvelopes imports the keys for the whole batch, then retries
+                missingKeys.append(doc)
+                return result
+
+            self.keyResolver.resolve(doc['digital_signature']['key_location'])
 
             try:
                 result["verified"] = self.verifytool.verify(doc)
@@ -132,26 +229,154 @@ class PipeTool(object):
 
         return result
 
-    def validateEnvelopes(self, envelopes):
-        result = []
-        for envelope in envelopes:
-            result.append(self._validate_digital_signature(envelope))
+    def _mapOrdered(self, func, items, workers=1):
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            # each verification waits on its own gpg process, so threads are enough;
+            # map keeps the results in input order
+            pool = ThreadPool(workers)
+            try:
+                return pool.map(func, items)
+            finally:
+                pool.close()
+                pool.join()
+        return map(func, items)
+
+    def validateEnvelopes(self, envelopes, workers=1):
+        envelopes = list(envelopes)
+        missingKeys = []
+        result = self._mapOrdered(lambda envelope: self._validate_digital_signature(envelope, missingKeys), envelopes, workers)
+
+        if len(missingKeys) > 0:
+            self.keyResolver.resolve_many([doc['digital_signature']['key_location'] for doc in missingKeys])
+            retry = set([id(doc) for doc in missingKeys])
+            positions = [idx for idx, envelope in enumerate(envelopes) if id(envelope) in retry]
+            retried = self._mapOrdered(self._validate_digital_signature, [envelopes[idx] for idx in positions], workers)
+            for idx, retriedResult in zip(positions, retried):
+                result[idx] = retriedResult
         return result
 
 
-    def publishEnvelopes(self, envelopes):
-        import urllib2,json
+    def _publishRequest(self):
+        import urllib2
         req = urllib2.Request(self.args.publish_url, headers={"Content-type": "application/json; charset=utf-8"})
         if self.args.publish_username and self.args.publish_password:
             import base64
             base64string = base64.encodestring('%s:%s' % (self.args.publish_username, self.args.publish_password))[:-1]
             req.add_header("Authorization", "Basic %s" % base64string)
-        status = []
-        for chunk in self._chunkList(envelopes, self.args.publish_chunksize):
-            res = urllib2.urlopen(req, data=json.dumps({ "documents":chunk }), timeout=self.args.publish_timeout)
-            status.append(json.load(res))
+        return req
+
+    def _publishChunk(self, chunk):
+        '''
+        Publishes a chunk and returns the node's statuses for it: one, or more
+        if the node refused the chunk as too large and it went in parts. A chunk
+        that is given up on gets a status with OK false and the error, so the
+        chunks after it are still published.
+        '''
+        import urllib2, httplib, socket, json, time, logging
+        from LRSignature.util.jsonstream import gzipDocuments, refusesGzip
+        compressed = self.publishGzip
+        if compressed:
+            body = gzipDocuments(chunk)
+        else:
+            body = json.dumps({ "documents":chunk })
+        attempt = 0
+        while True:
+            try:
+                started = time.time()
+                # a Request per attempt, urlopen adds the body to it
+                req = self._publishRequest()
+                if compressed:
+                    req.add_header("Content-Encoding", "gzip")
+                res = self.publishConnections.urlopen(req, data=body, timeout=self.args.publish_timeout)
+                status = json.load(res)
+                if compressed and status.get("OK") == False and refusesGzip(error=status.get("error")):
+                    # the node can't read gzip bodies, send them as they are from now on
+                    logging.info("Publish could not read a gzip body: %s. Publishing uncompressed.", status.get("error"))
+                    self.publishGzip = compressed = False
+                    body = json.dumps({ "documents":chunk })
+                    continue
+                self.publishBatcher.succeeded(time.time() - started)
+                return [status]
+            except urllib2.HTTPError, e:
+                if compressed and refusesGzip(code=e.code):
+                    logging.info("Publish responded with %s %s to a gzip body. Publishing uncompressed.", e.code, e.msg)
+                    self.publishGzip = compressed = False
+                    body = json.dumps({ "documents":chunk })
+                    continue
+                if e.code == 413 or e.code >= 500:
+                    self.publishBatcher.failed()
+                if e.code == 413 and len(chunk) > 1:
+                    # the same chunk would be refused again, send it in halves
+                    half = len(chunk) / 2
+                    return self._publishChunk(chunk[:half]) + self._publishChunk(chunk[half:])
+                # only server side errors are worth another try
+                if (e.code < 500 and e.code != 429) or attempt >= self.args.publish_retries:
+                    logging.error("Publish responded with %s %s. Giving up on %d envelopes.", e.code, e.msg, len(chunk))
+                    return [{"OK": False, "error": "%s %s" % (e.code, e.msg)}]
+                logging.info("Publish responded with %s %s. Going to retry.", e.code, e.msg)
+            except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                if isinstance(e, socket.timeout):
+                    self.publishBatcher.failed()
+                if attempt >= self.args.publish_retries:
+                    logging.error("Publish failed: %s. Giving up on %d envelopes.", e, len(chunk))
+                    return [{"OK": False, "error": str(e)}]
+                logging.info("Publish failed: %s. Going to retry.", e)
+            time.sleep(self.args.publish_backoff * (2 ** attempt))
+            attempt += 1
+
+    def _publishStream(self, envelopes):
+        '''
+        Publishes envelopes in chunks of --publish-chunksize envelopes (and at
+        most --publish-chunkbytes bytes), keeping up to --publish-concurrency
+        chunks in flight, and yields the status of each chunk in order as soon
+        as it is in.
+        '''
+        from LRSignature.util.pool import ConnectionPool
+        from LRSignature.util.batch import AdaptiveBatcher
+        concurrency = max(1, self.args.publish_concurrency)
+        self.publishConnections = ConnectionPool(maxsize=concurrency)
+        self.publishBatcher = AdaptiveBatcher(maxBytes=self.args.publish_chunkbytes, maxDocuments=self.args.publish_chunksize)
+        self.publishGzip = self.args.publish_gzip
+
+        chunks = self.publishBatcher.batches(envelopes)
+        if concurrency == 1:
+            for chunk in chunks:
+                for status in self._publishChunk(chunk):
+                    yield status
+            return
+
+        import collections
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(concurrency)
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                while len(pending) >= concurrency:
+                    for status in pending.popleft().get():
+                        yield status
+                pending.append(pool.apply_async(self._publishChunk, (chunk,)))
+                while len(pending) > 0 and pending[0].ready():
+                    for status in pending.popleft().get():
+                        yield status
+            while len(pending) > 0:
+                for status in pending.popleft().get():
+                    yield status
+        finally:
+            pool.close()
+            pool.join()
+            self.publishConnections.close()
 
-        print json.dumps(status)
+    def publishEnvelopes(self, envelopes):
+        import json
+        # same output as json.dumps(statusList), written as each chunk is published
+        sys.stdout.write('[')
+        for idx, status in enumerate(self._publishStream(envelopes)):
+            if idx > 0:
+                sys.stdout.write(', ')
+            sys.stdout.write(json.dumps(status))
+            sys.stdout.flush()
+        sys.stdout.write(']\n')
 
     def signEnvelopes(self, envelopes, is_test_data=True):
         signedEnvelopes = []
@@ -174,16 +399,30 @@ class PipeTool(object):
         sign_parser.add_argument('--publish-url', help='URL of publish service on node to send envelopes, default STDOUT', default=None)
         sign_parser.add_argument('--publish-chunksize', help='publish chunksize, default 25', type=int, default=25)
         sign_parser.add_argument('--publish-timeout', help='publish timeout in seconds, default 300', type=int, default=300)
+        sign_parser.add_argument('--publish-chunkbytes', help='publish chunk size limit in bytes, adapted to how the node copes, default none', type=int, default=None)
+        sign_parser.add_argument('--publish-gzip', help='send publish chunks gzip compressed, uncompressed if the node refuses them', action="store_true")
+        sign_parser.add_argument('--publish-concurrency', help='number of chunks published concurrently, default 1', type=int, default=1)
+        sign_parser.add_argument('--publish-retries', help='times a chunk is retried after a transient error, default 3', type=int, default=3)
+        sign_parser.add_argument('--publish-backoff', help='seconds before the first retry, doubled for each further one, default 1', type=float, default=1.0)
         sign_parser.add_argument('--publish-username', help='publish userame for basic HTTP auth', default=None)
         sign_parser.add_argument('--publish-password', help='publish password for basic HTTP auth', default=None)
         sign_parser.add_argument('--gpgbin', help='Path to GPG binary')
         sign_parser.add_argument('--gnupghome', help='Path to GPG home directory')
+        sign_parser.add_argument('--ndjson', help='read and write one JSON document per line, streaming', action="store_true")
         sign_parser.set_defaults(mode="sign")
 
         verify_parser = subparsers.add_parser('verify')
         verify_parser.set_defaults(mode="verify")
         verify_parser.add_argument('--gpgbin', help='Path to GPG binary')
         verify_parser.add_argument('--gnupghome', help='Path to GPG home directory')
+        verify_parser.add_argument('--ndjson', help='read and write one JSON document per line, streaming', action="store_true")
+        verify_parser.add_argument('--workers', help='number of envelopes verified concurrently, default 1', type=int, default=1)
+        verify_parser.add_argument('--cache', help='sqlite file to remember verification results in, default none', default=None)
+        verify_parser.add_argument('--key-cache', help='directory to keep fetched public keys in, default memory only', default=None)
+        verify_parser.add_argument('--key-cache-ttl', help='seconds a fetched public key is reused, default 86400', type=int, default=86400)
+        verify_parser.add_argument('--harvest-url', help='listrecords URL of a node to harvest and verify instead of reading STDIN', default=None)
+        verify_parser.add_argument('--harvest-checkpoint', help='file to keep the harvest resumption token in, default none', default=None)
+        verify_parser.add_argument('--harvest-timeout', help='harvest timeout in seconds, default 300', type=int, default=300)
 
         parser.add_argument('--gpgbin', help='Path to GPG binary', default="gpg")
         parser.add_argument('--gnupghome', help='Path to GPG home directory', default="~/.gnupg")
@@ -193,66 +432,105 @@ class PipeTool(object):
         return args
 
 
-    def parseInput(self, input=None):
-        import json
+    def _harvestRecords(self, obj):
+        def harvestGetRecordGenerator(results):
+            for item in results:
+                if "resource_data" in item:
+                    yield item["resource_data"]
 
-        def getHarvestRecords(obj):
-            def harvestGetRecordGenerator(results):
-                for item in results:
-                    if "resource_data" in item:
-                        yield item["resource_data"]
+        def harvestListRecordsGenerator(results):
+            for item in results:
+                if "record" in item and "resource_data" in item["record"]:
+                    yield item["record"]["resource_data"]
 
-            def harvestListRecordsGenerator(results):
-                for item in results:
-                    if "record" in item and "resource_data" in item["record"]:
-                        yield item["record"]["resource_data"]
+        try:
+            root = obj["getrecord"]["record"]
+            return harvestGetRecordGenerator(root)
+        except:
+            pass
 
-            try:
-                root = obj["getrecord"]["record"]
-                return harvestGetRecordGenerator(root)
-            except:
-                pass
+        try:
+            root = obj["listrecords"]
+            return harvestListRecordsGenerator(root)
+        except:
+            pass
 
-            try:
-                root = obj["listrecords"]
-                return harvestListRecordsGenerator(root)
-            except:
-                pass
+        return None
 
-            return None
+    def _envelopesFrom(self, jsobject):
+        records = self._harvestRecords(jsobject)
+        if records != None:
+            return records
+        if isinstance(jsobject, types.DictionaryType):
+            if jsobject.has_key("documents") and isinstance(jsobject["documents"], types.ListType):
+                return jsobject["documents"]
+            return [jsobject]
+        elif isinstance(jsobject, types.ListType):
+            return jsobject
+        return None
 
+    def parseInput(self, input=None):
+        import json
 
         if input is not None:
             try:
                 jsobject = json.loads(input)
-
-                records = getHarvestRecords(jsobject)
-                if records != None:
-                    return records
-                if isinstance(jsobject, types.DictionaryType):
-                    if jsobject.has_key("documents") and isinstance(jsobject["documents"], types.ListType):
-                        return jsobject["documents"]
-                    return [jsobject]
-                elif isinstance(jsobject, types.ListType):
-                    return jsobject
+                return self._envelopesFrom(jsobject)
 
             except Exception, e:
                 raise InvalidJSONError(e.message)
         return None
 
+    def parseStream(self, fp):
+        '''
+        Incremental version of parseInput: yields the envelopes of a top level
+        array, a "documents" array or a "listrecords" or "getrecord" harvest
+        response one at a time while fp is being read, holding a single record
+        in memory.
 
+        Other input (a single envelope) is decoded whole and handled as
+        parseInput does.
+        '''
+        from LRSignature.util.jsonstream import JSONStream
 
-    def readInput(self):
-        import json
-        pipedInput = ''
+        stream = JSONStream(fp)
         try:
-            while True:
-                pipedInput += raw_input()
-
-        except EOFError:
-            pass
+            if stream.peek() == "[":
+                for envelope in stream.iterArray():
+                    yield envelope
+            elif stream.peek() == "{":
+                obj = {}
+                streamed = False
+                for key in stream.iterObject():
+                    if not streamed and key in ["listrecords", "documents"] and stream.peek() == "[":
+                        streamed = True
+                        for item in stream.iterArray():
+                            if key == "documents":
+                                yield item
+                            elif "record" in item and "resource_data" in item["record"]:
+                                yield item["record"]["resource_data"]
+                    elif not streamed and key == "getrecord" and stream.peek() == "{":
+                        getrecord = {}
+                        for subkey in stream.iterObject():
+                            if not streamed and subkey == "record" and stream.peek() == "[":
+                                streamed = True
+                                for item in stream.iterArray():
+                                    if "resource_data" in item:
+                                        yield item["resource_data"]
+                            else:
+                                getrecord[subkey] = stream.value()
+                        obj[key] = getrecord
+                    else:
+                        obj[key] = stream.value()
+                if not streamed:
+                    for envelope in self._envelopesFrom(obj):
+                        yield envelope
+            else:
+                stream.value()
+            stream.end()
 
-        return pipedInput
+        except ValueError, e:
+            raise InvalidJSONError(e.message)
 
 
 if __name__ == "__main__":
@@ -22,23 +22,133 @@ import hashlib
 import gnupg
 import types
 import os, copy
+import threading
+from multiprocessing.pool import ThreadPool
 from LRSignature.errors import UnknownKeyException
-from LRSignature.bencode import bencode
+from LRSignature.bencode import bencode, Bencached
+
+try:
+    import pgpy
+    from pgpy.constants import HashAlgorithm
+except ImportError:
+    pgpy = None
+
+BACKEND_GNUPG = "gnupg"
+BACKEND_PGPY = "pgpy"
+
+STRIPPED_FIELDS = ["digital_signature", "publishing_node", "update_timestamp", "node_timestamp", "create_timestamp", "doc_ID", "_id", "_rev"]
 
 def _cmp_version(version1, version2):
     def normalize(v):
         return [int(x) for x in re.sub(r'(\.0+)*$','', v).split(".")]
     return cmp(normalize(version1), normalize(version2))
 
+class _CanonicalHash(object):
+    '''
+    Streams the normalized, bencoded form of an envelope into SHA256 in a single
+    walk over the original envelope, without copying it or building the whole
+    bencoded string. The digest is the same as hashing
+    bencode(_bnormal(_stripEnvelope(envelope))):
+    
+        - None, True and False are encoded as the strings "null", "true", "false"
+        - numbers inside lists are dropped, numbers that are dict values are
+          kept as they are (so floats are rejected by bencode)
+        - tuples and any other types are not normalized, they are passed to
+          bencode unchanged
+    
+    fragments maps id() of a shared dict or list to a (value, Bencached) pair,
+    see Sign_0_21.register_constant.
+    '''
+    
+    FLUSH_SIZE = 4096
+    
+    def __init__(self, fragments={}):
+        self.sha = hashlib.sha256()
+        self.pending = []
+        self.fragments = fragments
+        self.flushSize = self.FLUSH_SIZE
+    
+    def _cached(self, value):
+        cached = self.fragments.get(id(value))
+        if cached is not None and cached[0] is value:
+            self.pending.append(cached[1].bencoded)
+            return True
+        return False
+    
+    def _flush(self):
+        self.sha.update("".join(self.pending))
+        self.pending = []
+    
+    def _string(self, value):
+        # bencode counts characters, the hash is taken over the UTF-8 bytes
+        self.pending.extend((str(len(value)), ":", value.encode("utf-8")))
+    
+    def _value(self, value, inList):
+        # strings are by far the most common values, test them first
+        if type(value) in (types.StringType, types.UnicodeType):
+            self._string(value)
+        elif value is None:
+            self.pending.append("4:null")
+        elif isinstance(value, types.BooleanType):
+            self.pending.append("4:true" if value else "5:false")
+        elif isinstance(value, (types.FloatType, types.IntType, types.LongType, types.ComplexType)):
+            if inList:
+                return
+            if type(value) in (types.IntType, types.LongType):
+                self.pending.append("i%de" % value)
+            else:
+                self.pending.append(bencode(value))
+        elif isinstance(value, types.ListType):
+            if self._cached(value):
+                return
+            self.pending.append("l")
+            for child in value:
+                self._value(child, True)
+            self.pending.append("e")
+        elif type(value) is types.DictType:
+            if self._cached(value):
+                return
+            self._dict(value, ())
+        else:
+            self.pending.append(bencode(value).encode("utf-8"))
+        
+        if self.flushSize and len(self.pending) >= self.flushSize:
+            self._flush()
+    
+    def _dict(self, value, skip):
+        self.pending.append("d")
+        for key in sorted(value.keys()):
+            if key in skip:
+                continue
+            self._string(key)
+            self._value(value[key], False)
+        self.pending.append("e")
+    
+    def fragment(self, value):
+        # keep every piece, nothing is hashed
+        self.flushSize = None
+        self._value(value, False)
+        return "".join(self.pending)
+    
+    def envelope(self, envelope):
+        self._dict(envelope, STRIPPED_FIELDS)
+        self._flush()
+        return self.sha.hexdigest()
+
 class Sign_0_21(object):
     '''
     Class for signing LR envelopes following version 0.21.0 of the LR Specification:
         see: https://docs.google.com/document/d/191BTary350To_4JokBUFZLFRMOEfGYrl_EHE6QZxUr8/edit
     '''
 
-    def __init__(self, privateKeyID=None, passphrase=None, gnupgHome=os.path.expanduser(os.path.join("~", ".gnupg")), gpgbin="/usr/local/bin/gpg", publicKeyLocations=[], sign_everything=True):
+    def __init__(self, privateKeyID=None, passphrase=None, gnupgHome=os.path.expanduser(os.path.join("~", ".gnupg")), gpgbin="/usr/local/bin/gpg", publicKeyLocations=[], sign_everything=True, backend=BACKEND_GNUPG, secretKeyFile=None):
         '''
         Constructor
+        
+        backend selects how signatures are made:
+            BACKEND_GNUPG (default) runs the gpg binary once per signature.
+            BACKEND_PGPY signs in-process with the PGPy package, using the
+            ASCII armored secret key exported to secretKeyFile.
         '''
         self.signatureMethod = "LR-PGP.1.0"
         self.privateKeyID = privateKeyID
@@ -48,6 +158,12 @@ class Sign_0_21(object):
         self.publicKeyLocations = publicKeyLocations
         self.min_doc_version = "0.21.0"
         self.sign_everything = sign_everything
+        self.backend = backend
+        self.fragments = {}
+        
+        if backend == BACKEND_PGPY:
+            self._init_pgpy(secretKeyFile)
+            return
         
         self.gpg = gnupg.GPG(gnupghome=self.gnupgHome, gpgbinary=self.gpgbin)
         
@@ -67,6 +183,41 @@ class Sign_0_21(object):
             if privateKeyAvailable == False:
                 raise UnknownKeyException(self.privateKeyID)
     
+    def _init_pgpy(self, secretKeyFile):
+        if pgpy == None:
+            raise ImportError("The pgpy signing backend requires the PGPy package")
+        
+        self.secretKey, _ = pgpy.PGPKey.from_file(secretKeyFile)
+        # unlocking a protected key is not thread safe, see _pgpy_sign
+        self._pgpyLock = threading.Lock()
+        
+        fingerprint = str(self.secretKey.fingerprint).replace(" ", "")
+        if self.privateKeyID != None and self.privateKeyID not in [fingerprint, fingerprint[-16:]]:
+            raise UnknownKeyException(self.privateKeyID)
+        
+        uids = []
+        for uid in self.secretKey.userids:
+            owner = uid.name
+            if uid.comment:
+                owner += " ({0})".format(uid.comment)
+            if uid.email:
+                owner += " <{0}>".format(uid.email)
+            uids.append(owner)
+        self.privateKeyInfo = {"keyid": fingerprint[-16:], "fingerprint": fingerprint, "uids": uids}
+    
+    def _pgpy_sign(self, msg):
+        message = pgpy.PGPMessage.new(msg, cleartext=True)
+        if self.secretKey.is_protected:
+            self._pgpyLock.acquire()
+            try:
+                with self.secretKey.unlock(self.passphrase):
+                    message |= self.secretKey.sign(message, hash=HashAlgorithm.SHA256)
+            finally:
+                self._pgpyLock.release()
+        else:
+            message |= self.secretKey.sign(message, hash=HashAlgorithm.SHA256)
+        return str(message)
+    
     def _version_check(self, doc):
         return _cmp_version(doc["doc_version"], self.min_doc_version) >= 0
 
@@ -103,9 +254,8 @@ class Sign_0_21(object):
                 return obj
     
     def _stripEnvelope(self, envelope={}):
-        fields = ["digital_signature", "publishing_node", "update_timestamp", "node_timestamp", "create_timestamp", "doc_ID", "_id", "_rev"]
         sigObj = copy.deepcopy(envelope)
-        for field in fields:
+        for field in STRIPPED_FIELDS:
             if sigObj.has_key(field):
                 del sigObj[field]
         return sigObj
@@ -131,15 +281,28 @@ class Sign_0_21(object):
             3. Hash the Bencoded string using a SHA256
             4. Convert SHA256 to hexadecimal digest.
             
+        The steps are streamed in one pass over the envelope (see _CanonicalHash),
+        which gives the same digest as running _stripEnvelope, _bnormal,
+        _buildCanonicalString and _hash in turn.
+            
         Returns digest as string.
         '''
         
-        stripped = self._stripEnvelope(envelope)
-        normalized = self._bnormal(stripped)
-        canonical = self._buildCanonicalString(normalized)
-        hashedDigest = self._hash(canonical)
+        return _CanonicalHash(self.fragments).envelope(envelope)
+    
+    def register_constant(self, *values):
+        '''
+        Registers dicts and lists that are shared, unchanged, by many envelopes
+        (the same object, not an equal copy). Their normalized bencoded form is
+        computed once and reused by get_message whenever the object is met again.
         
-        return hashedDigest
+        Registered objects must not be modified afterwards.
+        '''
+        for value in values:
+            if not isinstance(value, (types.DictType, types.ListType)):
+                raise TypeError("Only dicts and lists can be registered")
+            fragment = Bencached(_CanonicalHash(self.fragments).fragment(value))
+            self.fragments[id(value)] = (value, fragment)
     
     def _get_privatekey_owner(self):
         if self.privateKeyInfo.has_key("uids") and isinstance(self.privateKeyInfo["uids"], types.ListType):
@@ -168,18 +331,39 @@ class Sign_0_21(object):
         if self._version_check(envelope) or self.sign_everything:
             msg = self.get_message(envelope)
             
-            signPrefs = {
-                         "keyid": self.privateKeyID,
-                         "passphrase": self.passphrase,
-                         "clearsign": True 
-                    }
-            
-            result = self.gpg.sign(msg, **signPrefs)
-            
+            if self.backend == BACKEND_PGPY:
+                sigdata = self._pgpy_sign(msg)
+            else:
+                signPrefs = {
+                             "keyid": self.privateKeyID,
+                             "passphrase": self.passphrase,
+                             "clearsign": True 
+                        }
+                
+                result = self.gpg.sign(msg, **signPrefs)
+                sigdata = result.data
             
-            envelope["digital_signature"] = self._get_sig_block(result.data)
+            envelope["digital_signature"] = self._get_sig_block(sigdata)
         
         return envelope
+    
+    def sign_many(self, envelopes, workers=4):
+        '''
+        Hashes and Signs a list of LR envelopes. With the gnupg backend every
+        signature is made by its own gpg process; up to workers of them are kept
+        running at the same time.
+        
+        Returns the signed envelopes in their original order.
+        '''
+        if workers <= 1 or len(envelopes) <= 1:
+            return [self.sign(envelope) for envelope in envelopes]
+        
+        pool = ThreadPool(min(workers, len(envelopes)))
+        try:
+            return pool.map(self.sign, envelopes)
+        finally:
+            pool.close()
+            pool.join()
         
 
 
@@ -18,8 +18,10 @@ Created on May 6, 2011
 @author: jklo
 '''
 import unittest, json, calendar, time, os, logging
+import gnupg
 from gnupg import GPG
-from LRSignature.sign.Sign import Sign_0_21
+from LRSignature.sign.Sign import Sign_0_21, BACKEND_PGPY
+from LRSignature.sign import Sign as SignModule
 from LRSignature.errors import UnknownKeyException
 import types
 import sys
@@ -429,6 +431,33 @@ class Test(unittest.TestCase):
         message = signer.get_message(origJson)
         assert benchmark == message
     
+    def testGetMessageMatchesStagedHash(self):
+        origJson = json.loads(self.sampleJSON)
+        origJson["resource_data"] = {u"title": u"Caf\xe9 \u2603", "count": 12, "flags": [True, False, None, 1, {"nested": 7}], "empty": {}}
+        origJson["active"] = True
+        
+        signer = Sign_0_21(self.goodkeyid, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin)
+        staged = signer._hash(signer._buildCanonicalString(signer._bnormal(signer._stripEnvelope(origJson))))
+        assert staged == signer.get_message(origJson), "streamed hash differs from the staged hash"
+    
+    def testRegisterConstant(self):
+        shared = {"submitter": "Bookshare.org", "submitter_type": "agent", "flags": [True, None, 3]}
+        envelopes = []
+        for idx in range(3):
+            envelope = json.loads(self.sampleJSON)
+            envelope["identity"] = shared
+            envelope["resource_locator"] = "http://example.com/resource/{0}".format(idx)
+            envelopes.append(envelope)
+        
+        signer = Sign_0_21(self.goodkeyid, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin)
+        expected = [signer.get_message(envelope) for envelope in envelopes]
+        signer.register_constant(shared)
+        assert expected == [signer.get_message(envelope) for envelope in envelopes], "cached fragment changed the hash"
+        
+        equalCopy = json.loads(json.dumps(envelopes[0]))
+        assert expected[0] == signer.get_message(equalCopy)
+        self.assertRaises(TypeError, signer.register_constant, "not a container")
+    
     def testPrivateKeyOwner(self):
         benchmark = self.goodowner
         signer = Sign_0_21(self.goodkeyid, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin)
@@ -511,6 +540,61 @@ class Test(unittest.TestCase):
         assert sig.has_key("signature")
         assert sig["signature"] != None and len(sig["signature"]) > 0
 
+    def testSignMany(self):
+        arbitraryKeyLoc = self.sampleKeyLocations
+        unsigned = []
+        for idx in range(10):
+            envelope = json.loads(self.sampleJSON)
+            envelope["resource_locator"] = "http://example.com/resource/{0}".format(idx)
+            unsigned.append(envelope)
+        
+        signer = Sign_0_21(self.goodkeyid, passphrase=self.goodpassphrase, publicKeyLocations=arbitraryKeyLoc, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin)
+        signed = signer.sign_many(unsigned, workers=4)
+        
+        assert len(signed) == len(unsigned), "signed envelopes missing"
+        for idx, envelope in enumerate(signed):
+            assert envelope["resource_locator"] == "http://example.com/resource/{0}".format(idx), "envelopes not returned in original order"
+            assert envelope.has_key("digital_signature")
+            sig = envelope["digital_signature"]
+            assert sig["signature"] != None and signer.get_message(envelope) in sig["signature"], "signature does not belong to envelope"
+
+    def testSignPgpyBackend(self):
+        if SignModule.pgpy == None:
+            log.info("Skipping test, PGPy is not installed.")
+            return
+        
+        secretKeyFile = os.path.join(self.gnupgHome, "secret.asc")
+        with open(secretKeyFile, "w") as f:
+            f.write(self.gpg.export_keys(self.goodkeyid, secret=True))
+        
+        unsigned = json.loads(self.sampleJSON)
+        signer = Sign_0_21(self.goodkeyid, passphrase=self.goodpassphrase, publicKeyLocations=self.sampleKeyLocations, backend=BACKEND_PGPY, secretKeyFile=secretKeyFile)
+        signed = signer.sign(unsigned)
+        
+        assert signed.has_key("digital_signature")
+        sig = signed["digital_signature"]
+        assert signer.get_message(signed) in sig["signature"], "signature does not belong to envelope"
+        assert sig["key_owner"] == self.goodowner
+        
+        verified = self.gpg.verify(sig["signature"])
+        assert verified.valid == True, "gpg could not verify the in-process signature"
+    
+    def testSignThreadedAndMultiplexedIO(self):
+        '''Signing gives the same result whether gpg's pipes are served by threads or by poll'''
+        message = "line of a long message\n" * 10000
+        multiplexed = gnupg._MULTIPLEX_IO
+        try:
+            for multiplex in [True, False]:
+                gnupg._MULTIPLEX_IO = multiplex
+                signed = self.gpg.sign(message, keyid=self.goodkeyid, passphrase=self.goodpassphrase, clearsign=True)
+                assert signed.data.startswith("-----BEGIN PGP SIGNED MESSAGE-----"), "no signed message"
+                assert message in signed.data.replace("\r\n", "\n"), "message not copied to gpg in full"
+                
+                verified = self.gpg.verify(signed.data)
+                assert verified.valid == True, "signature does not verify"
+        finally:
+            gnupg._MULTIPLEX_IO = multiplexed
+    
     def testSignUnicode(self):
         if self.testDataUnicode == None:
             log.info("Skipping test, unicode test data file not set.")
@@ -17,9 +17,17 @@ Created on May 11, 2011
 
 @author: jklo
 '''
-import unittest, os, errno
+import unittest, os, errno, tempfile, shutil, json
+from cStringIO import StringIO
 import gnupg
 from LRSignature import util as util
+from LRSignature.util.keys import KeyResolver
+from LRSignature.util.jsonstream import JSONStream
+from LRSignature.util.harvest import ListRecordsHarvest
+from LRSignature.util.batch import AdaptiveBatcher
+from LRSignature.util.pool import ConnectionPool
+import socket, time, SocketServer
+import BaseHTTPServer, threading, urlparse
 
 class Test(unittest.TestCase):
     '''Unit test cases for testing utility methods'''
@@ -212,6 +220,232 @@ Mi8vo0LKU7qAlMXpAa5+tw==
         for key in keys:
             assert key['keyid'] == self.sampleKeyId, "exported key is not expected"
     
+    def fakeFetch(self, fetched):
+        def fetch(url):
+            fetched.append(url)
+            if url == "http://example.com/key":
+                return [self.sampleKey]
+            if url == "http://example.com/down":
+                raise IOError("unreachable")
+            return []
+        return fetch
+    
+    def testKeyResolverFetchesOnce(self):
+        '''Resolve keys for many documents from the same signer; the key is fetched and imported once'''
+        fetched = []
+        resolver = KeyResolver(self.gpg, fetch=self.fakeFetch(fetched))
+        
+        numImported = resolver.resolve_many([["http://example.com/down", "http://example.com/key"]] * 1000)
+        assert numImported == 1, "sample key not imported into keyring"
+        assert fetched == ["http://example.com/down", "http://example.com/key"], "key locations fetched more than once"
+        
+        numImported = resolver.resolve(["http://example.com/key"])
+        assert numImported == 0, "sample key imported twice"
+        assert len(fetched) == 2, "cached key location fetched again"
+        
+        keys = self.gpg.list_keys(secret=False)
+        assert len(keys) == 1 and keys[0]['keyid'] == self.sampleKeyId, "exported key is not expected"
+    
+    def testKeyResolverRetriesFailedImport(self):
+        '''A key block gpg did not import is offered again with the next batch'''
+        imports = []
+        class ImportResult(object):
+            def __init__(self, fingerprints):
+                self.fingerprints = fingerprints
+                self.imported = len(fingerprints)
+                self.not_imported = 0
+        class FlakyGPG(object):
+            def import_keys(self, data):
+                imports.append(data)
+                if len(imports) == 1:
+                    return ImportResult([])
+                return ImportResult(["FINGERPRINT"])
+        resolver = KeyResolver(FlakyGPG(), fetch=lambda url: ["-----BEGIN PGP PUBLIC KEY BLOCK-----"])
+        
+        assert resolver.resolve(["http://example.com/key"]) == 0
+        assert resolver.resolve(["http://example.com/key"]) == 1, "key not offered again after a failed import"
+        assert resolver.resolve(["http://example.com/key"]) == 0 and len(imports) == 2, "imported key offered again"
+    
+    def testKeyResolverNegativeCache(self):
+        '''Key locations without a key are not retried until negativeTtl has passed'''
+        fetched = []
+        resolver = KeyResolver(self.gpg, fetch=self.fakeFetch(fetched), negativeTtl=3600)
+        resolver.resolve(["http://example.com/empty"])
+        resolver.resolve(["http://example.com/empty"])
+        assert fetched == ["http://example.com/empty"], "failed key location retried within negativeTtl"
+        
+        resolver.negativeTtl = 0
+        resolver.resolve(["http://example.com/empty"])
+        assert len(fetched) == 2, "failed key location not retried after negativeTtl"
+    
+    def testKeyResolverDiskCache(self):
+        '''Fetched keys are kept on disk for the next resolver'''
+        cacheDir = tempfile.mkdtemp()
+        try:
+            fetched = []
+            KeyResolver(self.gpg, cacheDir=cacheDir, fetch=self.fakeFetch(fetched)).keys("http://example.com/key")
+            rawKeys = KeyResolver(self.gpg, cacheDir=cacheDir, fetch=self.fakeFetch(fetched)).keys("http://example.com/key")
+            assert fetched == ["http://example.com/key"], "key fetched again despite the disk cache"
+            assert rawKeys == [self.sampleKey], "cached key differs from the fetched one"
+        finally:
+            shutil.rmtree(cacheDir, ignore_errors=True)
+    
+    def testJSONStream(self):
+        '''Stream the records of a listrecords response, reading a few bytes at a time'''
+        records = [{"record": {"resource_data": {"doc_ID": str(idx), "number": -12.5e3, "flags": [True, None]}}} for idx in range(20)]
+        document = json.dumps({"OK": True, "listrecords": records, "resumption_token": None}, indent=2)
+        
+        for chunkSize in [1, 7, 65536]:
+            stream = JSONStream(StringIO(document), chunkSize=chunkSize)
+            streamed = {}
+            for key in stream.iterObject():
+                if key == "listrecords":
+                    streamed[key] = [record for record in stream.iterArray()]
+                else:
+                    streamed[key] = stream.value()
+            stream.end()
+            assert streamed == json.loads(document), "streamed document differs with chunkSize {0}".format(chunkSize)
+        
+        for malformed in ["", "[1,", "[1] 2", '{"a" 1}']:
+            stream = JSONStream(StringIO(malformed), chunkSize=1)
+            def parse():
+                stream.value()
+                stream.end()
+            self.assertRaises(ValueError, parse)
+    
+    def startHarvestServer(self, pageCount, pageSize):
+        '''Serves listrecords pages of pageSize records, chained by resumption_token'''
+        requested = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                page = int(query.get("resumption_token", ["0"])[0])
+                requested.append(page)
+                records = [{"record": {"resource_data": {"doc_ID": "{0}-{1}".format(page, idx)}}} for idx in range(pageSize)]
+                token = None
+                if page + 1 < pageCount:
+                    token = str(page + 1)
+                body = json.dumps({"OK": True, "listrecords": records, "resumption_token": token})
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:{0}/harvest/listrecords".format(server.server_port), requested
+    
+    def testHarvestPages(self):
+        '''Follow resumption tokens to the last page'''
+        url, requested = self.startHarvestServer(3, 4)
+        pages = [[record["doc_ID"] for record in records] for records in ListRecordsHarvest(url).pages()]
+        assert len(pages) == 3 and all(len(page) == 4 for page in pages), "pages missing"
+        assert pages[2][3] == "2-3", "unexpected records on last page"
+        assert requested == [0, 1, 2], "pages not requested in order"
+    
+    def testHarvestCheckpoint(self):
+        '''An interrupted harvest resumes after the last page handled'''
+        url, requested = self.startHarvestServer(4, 2)
+        checkpointPath = os.path.join(tempfile.mkdtemp(), "harvest.checkpoint")
+        try:
+            for idx, records in enumerate(ListRecordsHarvest(url, checkpointPath=checkpointPath).pages()):
+                if idx == 1:
+                    break
+            assert os.path.exists(checkpointPath), "checkpoint not saved"
+            
+            resumed = [records[0]["doc_ID"] for records in ListRecordsHarvest(url, checkpointPath=checkpointPath).pages()]
+            assert resumed == ["1-0", "2-0", "3-0"], "harvest did not resume after the last handled page"
+            assert not os.path.exists(checkpointPath), "checkpoint kept after the last page"
+        finally:
+            shutil.rmtree(os.path.dirname(checkpointPath), ignore_errors=True)
+        
+    def testAdaptiveBatcher(self):
+        '''Batches are packed up to the byte target, which follows publish outcomes'''
+        envelopes = [{"doc_ID": "{0:02d}".format(idx), "payload": "x" * 80} for idx in range(20)]
+        envelopeBytes = AdaptiveBatcher().size(envelopes[0])
+        
+        batcher = AdaptiveBatcher(maxBytes=envelopeBytes * 4, maxDocuments=3)
+        assert [len(batch) for batch in batcher.batches(envelopes)] == [3] * 6 + [2], "maxDocuments not respected"
+        
+        batcher = AdaptiveBatcher(maxBytes=envelopeBytes * 4, minBytes=envelopeBytes)
+        batches = list(batcher.batches(envelopes))
+        assert [len(batch) for batch in batches] == [4] * 5, "byte target not respected"
+        assert sum(batches, []) == envelopes, "envelopes lost or reordered"
+        
+        batcher.failed()
+        assert batcher.target == envelopeBytes * 2, "target not cut after a failure"
+        batcher.failed()
+        batcher.failed()
+        assert batcher.target == envelopeBytes, "target cut below minBytes"
+        batcher.succeeded(60)
+        assert batcher.target == envelopeBytes, "slow response did not keep the target down"
+        for idx in range(10):
+            batcher.succeeded(0.1)
+        assert batcher.target == envelopeBytes * 4, "target not grown back to maxBytes"
+        
+        huge = {"doc_ID": "huge", "payload": "x" * (envelopeBytes * 8)}
+        assert [len(batch) for batch in batcher.batches([envelopes[0], huge, envelopes[1]])] == [1, 1, 1], "oversized envelope not sent alone"
+        
+    def startPublishServer(self, behaviours):
+        '''Answers each POST per the next of behaviours: "ok", "drop" (close the
+        connection without answering) or "slow" (answer after two seconds)'''
+        received = []
+        clients = self.clients = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                behaviour = (behaviours + ["ok"] * 10)[len(received)]
+                received.append(behaviour)
+                clients.append(self.client_address)
+                if behaviour == "drop":
+                    self.close_connection = 1
+                    return
+                if behaviour == "slow":
+                    time.sleep(2)
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write("{}")
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:{0}/publish".format(server.server_port), received
+    
+    def testConnectionPoolResendsPostOnlyWhenUnanswered(self):
+        '''A POST on a reused connection is sent again after a dropped connection, never after a timeout'''
+        url, received = self.startPublishServer(["ok", "drop", "ok", "slow"])
+        pool = ConnectionPool(timeout=0.5)
+        pool.urlopen(url, data="{}")
+        assert pool.urlopen(url, data="{}").read() == "{}", "POST not resent after the idle connection was dropped"
+        assert received == ["ok", "drop", "ok"]
+        
+        self.assertRaises(socket.timeout, pool.urlopen, url, data="{}")
+        time.sleep(1)
+        assert received == ["ok", "drop", "ok", "slow"], "POST sent again after a timeout"
+    
+    def testConnectionPoolKeepAlive(self):
+        '''Requests to one host share a connection, which takes the timeout of each request'''
+        url, received = self.startPublishServer(["ok", "ok", "ok", "slow"])
+        pool = ConnectionPool(timeout=5)
+        for idx in range(3):
+            assert pool.urlopen(url, data="{}").read() == "{}"
+        assert len(set(self.clients)) == 1, "connection not reused: {0}".format(self.clients)
+        
+        self.assertRaises(socket.timeout, pool.urlopen, url, data="{}", timeout=0.5)
+        assert self.clients[3] == self.clients[0], "slow request not sent on the pooled connection"
+    
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testFetchKey']
@@ -23,6 +23,7 @@ from gnupg import GPG
 import time
 from LRSignature.sign.Sign import Sign_0_21
 from LRSignature.verify.Verify import Verify_0_21
+from LRSignature.verify.cache import VerifyCache
 from LRSignature import errors as errors
 
 #logging.basicConfig(level=logging.DEBUG,format="%(asctime)s %(levelname)-5s %(name)-10s %(threadName)-10s %(message)s")
@@ -342,6 +343,99 @@ class Test(unittest.TestCase):
         verified = verifytool.verify(alt_signed)
         assert verified == False, "verification failed, corrupted signature block verified as good"
         
+    def testVerifyMany(self):
+        '''Check that batch verification gives the same per envelope results as verify'''
+        signtool = Sign_0_21(privateKeyID=self.privateKey.fingerprint, passphrase=self.genericPassphrase, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin, publicKeyLocations=self.sampleKeyLocations)
+        envelopes = []
+        for idx in range(6):
+            unsigned = json.loads(self.sampleJSON)
+            unsigned["resource_locator"] = "http://example.com/resource/{0}".format(idx)
+            envelopes.append(signtool.sign(unsigned))
+        
+        envelopes[1]["X_corrupted"] = "Corrupted Envelope"
+        validHash = signtool.get_message(envelopes[2])
+        envelopes[2]["digital_signature"]["signature"] = envelopes[2]["digital_signature"]["signature"].replace(validHash, signtool.get_message(envelopes[1]))
+        del envelopes[3]["digital_signature"]
+        envelopes[4]["digital_signature"]["signing_method"] = "BAD_SIGNATURE_METHOD"
+        
+        verifytool = Verify_0_21(gpgbin=self.gpgbin, gnupgHome=self.gnupgHome)
+        results = verifytool.verify_many(envelopes, batchSize=2)
+        
+        assert len(results) == len(envelopes), "missing results"
+        assert results[0] == True, "valid envelope did not verify"
+        assert results[1] == False, "corrupted envelope verified as good"
+        assert results[2] == False, "corrupted signature verified as good"
+        assert results[3] == None, "unsigned envelope should have no result"
+        assert isinstance(results[4], errors.UnsupportedSignatureAlgorithm), "expected exception not returned"
+        assert results[5] == True, "envelope after a bad signature did not verify"
+        
+        verified = verifytool.get_and_verify_many(envelopes[:2])
+        assert verified[0].valid == True
+        assert isinstance(verified[1], errors.BadSignatureFormat), "expected exception not returned"
+        
+    def testVerifyCache(self):
+        '''Check that a cached outcome is reused until the envelope or the keyring changes'''
+        unsigned = json.loads(self.sampleJSON)
+        signtool = Sign_0_21(privateKeyID=self.privateKey.fingerprint, passphrase=self.genericPassphrase, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin, publicKeyLocations=self.sampleKeyLocations)
+        signed = signtool.sign(unsigned)
+        
+        verifytool = Verify_0_21(gpgbin=self.gpgbin, gnupgHome=self.gnupgHome, cache=VerifyCache(":memory:"))
+        gpgVerify = verifytool.gpg.verify
+        calls = []
+        def countingVerify(data):
+            calls.append(data)
+            return gpgVerify(data)
+        verifytool.gpg.verify = countingVerify
+        
+        assert verifytool.verify(signed) == True, "Envelope signature verification did not succeed, even though it should"
+        assert verifytool.verify(signed) == True, "cached outcome changed"
+        assert len(calls) == 1, "cached envelope was verified again"
+        
+        corrupted = copy.deepcopy(signed)
+        corrupted["X_corrupted"] = "Corrupted Envelope"
+        assert verifytool.verify(corrupted) == False, "corrupted envelope verified as good"
+        assert len(calls) == 2, "changed envelope was not verified"
+        
+        self.gpg.delete_keys([self.privateKey2.fingerprint], secret=True)
+        self.gpg.delete_keys([self.privateKey2.fingerprint], secret=False)
+        assert verifytool.verify(signed) == True
+        assert len(calls) == 3, "keyring change did not invalidate the cache"
+    
+    def testVerifyCacheEviction(self):
+        '''Check that the least recently used outcomes are evicted'''
+        cache = VerifyCache(":memory:", maxEntries=2)
+        cache.put("a", "keyring", True)
+        cache.put("b", "keyring", False)
+        time.sleep(0.01)
+        assert cache.get("a") == True
+        cache.put("c", "keyring", True)
+        assert cache.get("b") == None, "least recently used outcome was not evicted"
+        assert cache.get("a") == True and cache.get("c") == True
+        
+        cache.keyring_changed("other keyring")
+        assert cache.get("a") == None, "outcomes for an old keyring were kept"
+        
+    def testExtractHashLinear(self):
+        '''Benchmark hash extraction on large signature blocks, the time should grow linearly'''
+        verifytool = Verify_0_21(gpgbin=self.gpgbin, gnupgHome=self.gnupgHome)
+        
+        def block(numLines):
+            return "\n".join(["-----BEGIN PGP SIGNED MESSAGE-----"] + ["Comment: padding"] * numLines + ["", "0123456789abcdef"] + ["- padding"] * numLines +
+                              ["-----BEGIN PGP SIGNATURE-----", "", "=abcd", "-----END PGP SIGNATURE-----", ""])
+        
+        def timed(signatureBlock):
+            start = time.time()
+            extracted = verifytool._extractHashFromSignature(signatureBlock)
+            return time.time() - start, extracted
+        
+        smallTime, smallHash = timed(block(5000))
+        largeTime, largeHash = timed(block(50000))
+        log.info("Extracted hash with 5000 padding lines in {0:.4f}s, 50000 in {1:.4f}s".format(smallTime, largeTime))
+        
+        assert smallHash == "0123456789abcdef" + "- padding" * 5000, "wrong text extracted"
+        assert len(largeHash) == len("0123456789abcdef") + len("- padding") * 50000, "wrong text extracted"
+        assert largeTime < max(smallTime, 0.001) * 30, "extraction time grew faster than the signature block"
+        
     def testSignLRTestData(self):
         '''Test using LR Test Data, if available'''
         if self.testDataDir == None:
@@ -0,0 +1,128 @@
+'''
+Copyright 2011 SRI International
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import json
+import threading
+
+class AdaptiveBatcher(object):
+    '''
+    Packs envelopes into publish batches by their serialized size instead of
+    their number.
+
+    A batch is closed before the envelope that would take it over the current
+    byte target, or once it holds maxDocuments envelopes. An envelope larger
+    than the target goes out on its own. The target starts at maxBytes and
+    follows the node's behaviour: it is cut by shrink after a failure (413,
+    timeout, server error) or a response slower than slowSeconds, and grows by
+    growth, back up to maxBytes, after a response faster than fastSeconds.
+
+    Without maxBytes batches are counted in documents only, as before.
+
+    Params:
+        maxBytes : byte budget of a batch, default none
+        maxDocuments : number of envelopes in a batch, default none
+        minBytes : lowest the target is cut to, default maxBytes / 16
+        growth, shrink : factors the target is changed by
+        fastSeconds, slowSeconds : response times that grow or shrink the target
+    '''
+
+    def __init__(self, maxBytes=None, maxDocuments=None, minBytes=None, growth=1.25, shrink=0.5, fastSeconds=2.0, slowSeconds=30.0):
+        self.maxBytes = maxBytes
+        self.maxDocuments = maxDocuments
+        self.minBytes = minBytes
+        if minBytes == None and maxBytes != None:
+            self.minBytes = max(1, maxBytes / 16)
+        self.growth = growth
+        self.shrink = shrink
+        self.fastSeconds = fastSeconds
+        self.slowSeconds = slowSeconds
+        self.target = maxBytes
+        self.pending = []
+        self.pendingBytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def size(self, envelope):
+        # the ", " separating it from the previous envelope included
+        return len(json.dumps(envelope)) + 2
+
+    def _full(self):
+        if self.maxDocuments != None and len(self.pending) >= self.maxDocuments:
+            return True
+        return self.target != None and self.pendingBytes >= self.target
+
+    def add(self, envelope):
+        '''
+        Adds envelope to the pending batch. Returns the batches it completed,
+        usually none or one.
+        '''
+        ready = []
+        envelopeBytes = 0
+        if self.target != None:
+            envelopeBytes = self.size(envelope)
+            if len(self.pending) > 0 and self.pendingBytes + envelopeBytes > self.target:
+                ready.append(self.flush())
+        self.pending.append(envelope)
+        self.pendingBytes += envelopeBytes
+        if self._full():
+            ready.append(self.flush())
+        return ready
+
+    def flush(self):
+        '''
+        Returns the pending batch, possibly empty, and starts a new one.
+        '''
+        batch = self.pending
+        self.pending = []
+        self.pendingBytes = 0
+        return batch
+
+    def batches(self, envelopes):
+        '''
+        Yields the batches of an iterable of envelopes.
+        '''
+        for envelope in envelopes:
+            for batch in self.add(envelope):
+                yield batch
+        if len(self.pending) > 0:
+            yield self.flush()
+
+    def _resize(self, factor):
+        if self.target == None:
+            return
+        self._lock.acquire()
+        try:
+            self.target = int(min(self.maxBytes, max(self.minBytes, self.target * factor)))
+        finally:
+            self._lock.release()
+
+    def succeeded(self, seconds):
+        '''
+        Reports a batch the node took in seconds.
+        '''
+        if seconds <= self.fastSeconds:
+            self._resize(self.growth)
+        elif seconds >= self.slowSeconds:
+            self._resize(self.shrink)
+
+    def failed(self):
+        '''
+        Reports a batch the node rejected as too large, timed out on or
+        failed with a server error.
+        '''
+        self._resize(self.shrink)
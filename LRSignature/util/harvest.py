@@ -0,0 +1,138 @@
+'''
+Copyright 2011 SRI International
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import json
+import os
+import Queue
+import threading
+import urllib
+
+from LRSignature.util.pool import ConnectionPool
+
+END_OF_PAGES = object()
+
+class ListRecordsHarvest(object):
+    '''
+    Pages through a node's harvest/listrecords service by following the
+    resumption_token of each response, fetching the next page in the
+    background while the current one is being handled.
+
+    With checkpointPath, the token of the next page is saved once the caller
+    is done with a page, and a later harvest of the same url resumes from it.
+    The checkpoint is removed when the last page has been handled.
+
+    Params:
+        url : listrecords URL, e.g. http://node/harvest/listrecords
+        checkpointPath : file to keep the resumption token in, default none
+        timeout : socket timeout in seconds for each page
+        connections : LRSignature.util.pool.ConnectionPool to fetch with
+    '''
+
+    def __init__(self, url, checkpointPath=None, timeout=300, connections=None):
+        self.url = url
+        self.checkpointPath = checkpointPath
+        self.timeout = timeout
+        self.connections = connections or ConnectionPool(maxsize=1)
+
+    def _pageUrl(self, token):
+        if token == None:
+            return self.url
+        separator = "?" in self.url and "&" or "?"
+        return self.url + separator + urllib.urlencode({"resumption_token": token})
+
+    def fetch(self, token=None):
+        '''
+        Returns the resource_data of every record on a page and the token of
+        the next page (None after the last one).
+        '''
+        response = self.connections.urlopen(self._pageUrl(token), timeout=self.timeout)
+        page = json.load(response)
+        records = []
+        for item in page.get("listrecords", []):
+            if "record" in item and "resource_data" in item["record"]:
+                records.append(item["record"]["resource_data"])
+        return records, page.get("resumption_token") or None
+
+    def loadCheckpoint(self):
+        '''
+        Returns the resumption token saved for this url, or None.
+        '''
+        if self.checkpointPath == None or not os.path.exists(self.checkpointPath):
+            return None
+        with open(self.checkpointPath) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("url") != self.url:
+            return None
+        return checkpoint.get("resumption_token")
+
+    def saveCheckpoint(self, token):
+        if self.checkpointPath == None:
+            return
+        tmpPath = self.checkpointPath + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"url": self.url, "resumption_token": token}, f)
+        os.rename(tmpPath, self.checkpointPath)
+
+    def clearCheckpoint(self):
+        if self.checkpointPath != None and os.path.exists(self.checkpointPath):
+            os.remove(self.checkpointPath)
+
+    def _prefetch(self, token, pages, stop):
+        try:
+            while not stop.is_set():
+                records, nextToken = self.fetch(token)
+                self._put(pages, stop, (records, nextToken))
+                if nextToken == None:
+                    break
+                token = nextToken
+        except Exception as e:
+            self._put(pages, stop, e)
+        self._put(pages, stop, END_OF_PAGES)
+
+    def _put(self, pages, stop, item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def pages(self):
+        '''
+        Yields the records of each page, starting from the checkpoint if there
+        is one.
+        '''
+        pages = Queue.Queue(1)
+        stop = threading.Event()
+        prefetcher = threading.Thread(target=self._prefetch, args=(self.loadCheckpoint(), pages, stop))
+        prefetcher.setDaemon(True)
+        prefetcher.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is END_OF_PAGES:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                records, nextToken = item
+                yield records
+                # the caller has finished with this page
+                if nextToken == None:
+                    self.clearCheckpoint()
+                else:
+                    self.saveCheckpoint(nextToken)
+        finally:
+            stop.set()
@@ -0,0 +1,173 @@
+'''
+Copyright 2011 SRI International
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import gzip
+import json
+import re
+from cStringIO import StringIO
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+NUMBER_START = "-0123456789"
+NUMBER_CHARS = "0123456789.eE+-"
+# words in a node's error that say it could not read a compressed body
+GZIP_ERROR_WORDS = ["gzip", "decod", "content-encoding", "compress"]
+
+class JSONStream(object):
+    '''
+    Reads a JSON document from a file-like object a piece at a time, so the
+    members of a large array can be handled one by one without parsing the
+    whole document into memory.
+
+    Containers are walked with iterObject() and iterArray(); value() decodes
+    the next value completely. Only the value being decoded (plus one read
+    chunk) is held in memory.
+
+    Raises ValueError for malformed JSON.
+    '''
+
+    def __init__(self, fp, chunkSize=65536):
+        self.fp = fp
+        self.chunkSize = chunkSize
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        # drops what has been consumed and reads more; False at end of input
+        if self.eof:
+            return False
+        data = self.fp.read(size or self.chunkSize)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''
+        Returns the next character that is not whitespace, or None at the end
+        of input, without consuming it.
+        '''
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, chars):
+        ch = self.peek()
+        if ch == None or ch not in chars:
+            raise ValueError("Expecting one of {0!r} at offset {1}".format(chars, self.pos))
+        self.pos += 1
+        return ch
+
+    def value(self):
+        '''
+        Decodes and returns the next value.
+        '''
+        first = self.peek()
+        if first == None:
+            raise ValueError("No JSON object could be decoded")
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value that reaches the end of the buffer, or a number that
+                # may go on, can continue in the next chunk
+                complete = end < len(self.buf) and (first not in NUMBER_START or self.buf[end] not in NUMBER_CHARS)
+                if complete or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # grow reads with the value so a large value is decoded a bounded
+            # number of times
+            self._fill(max(self.chunkSize, len(self.buf) - self.pos))
+
+    def iterArray(self):
+        '''
+        Yields the members of the next value, which must be an array.
+        '''
+        self._expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._expect(",]") == "]":
+                return
+
+    def iterObject(self):
+        '''
+        Yields the keys of the next value, which must be an object. The caller
+        must consume the value of each key (with value(), iterArray() or
+        iterObject()) before asking for the next key.
+        '''
+        self._expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise ValueError("Expecting property name at offset {0}".format(self.pos))
+            key = self.value()
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+    def end(self):
+        '''
+        Checks that nothing but whitespace is left.
+        '''
+        if self.peek() != None:
+            raise ValueError("Extra data at offset {0}".format(self.pos))
+
+def gzipDocuments(documents, compresslevel=6):
+    '''
+    Returns json.dumps({"documents": documents}) compressed with gzip. The
+    JSON is built and compressed one document at a time, so the uncompressed
+    body is never held in memory as a whole.
+    '''
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=compresslevel)
+    gz.write('{"documents": [')
+    for idx, document in enumerate(documents):
+        if idx > 0:
+            gz.write(', ')
+        gz.write(json.dumps(document))
+    gz.write(']}')
+    gz.close()
+    return buf.getvalue()
+
+def refusesGzip(code=None, error=None):
+    '''
+    Tells whether a failed publish of a gzip body means the node can't read
+    gzip: an HTTP 415, or an error naming the encoding. Other failures (a
+    batch that does not validate, say) say nothing about compression.
+    '''
+    if code == 415:
+        return True
+    if error == None:
+        return False
+    error = unicode(error).lower()
+    for word in GZIP_ERROR_WORDS:
+        if word in error:
+            return True
+    return False
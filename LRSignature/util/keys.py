@@ -0,0 +1,171 @@
+'''
+Copyright 2011 SRI International
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from LRSignature import util
+
+log = logging.getLogger(__name__)
+
+class KeyResolver(object):
+    '''
+    Finds and imports the public keys needed to verify signatures, fetching
+    each key_location at most once per ttl.
+
+    Fetched key blocks are kept in memory by URL and, when cacheDir is given,
+    on disk so later runs can skip the download too. A location that fails to
+    download or holds no key is remembered for negativeTtl seconds. Key blocks
+    are imported into the keyring of gpg (a gnupg.GPG object) once; all the
+    blocks a batch needs go in a single import_keys call.
+
+    Params:
+        gpg : gnupg.GPG object for the keyring to import into
+        cacheDir : directory for the on-disk cache, default none
+        ttl : seconds a fetched key block is reused
+        negativeTtl : seconds a failed location is not retried
+        fetch : function returning the key blocks at a URL (util.fetchkeys)
+    '''
+
+    def __init__(self, gpg, cacheDir=None, ttl=86400, negativeTtl=3600, fetch=util.fetchkeys):
+        self.gpg = gpg
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.fetch = fetch
+        self._entries = {}
+        self._imported = set()
+        self._lock = threading.Lock()
+        self._urlLocks = {}
+        if cacheDir != None and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def _isFresh(self, entry):
+        ttl = self.ttl
+        if len(entry["keys"]) == 0:
+            ttl = self.negativeTtl
+        return time.time() - entry["fetched"] < ttl
+
+    def _cachePath(self, url):
+        return os.path.join(self.cacheDir, hashlib.sha256(url).hexdigest() + ".json")
+
+    def _readDisk(self, url):
+        if self.cacheDir == None:
+            return None
+        try:
+            with open(self._cachePath(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def _writeDisk(self, url, entry):
+        if self.cacheDir == None:
+            return
+        path = self._cachePath(url)
+        tmpPath = "{0}.{1}.tmp".format(path, threading.current_thread().ident)
+        try:
+            with open(tmpPath, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmpPath, path)
+        except (IOError, OSError):
+            log.exception("Could not write key cache entry for %s", url)
+
+    def _urlLock(self, url):
+        self._lock.acquire()
+        try:
+            if url not in self._urlLocks:
+                self._urlLocks[url] = threading.Lock()
+            return self._urlLocks[url]
+        finally:
+            self._lock.release()
+
+    def keys(self, url):
+        '''
+        Returns the key blocks published at url, from the cache when fresh.
+        Concurrent callers asking for the same url share one download.
+        '''
+        urlLock = self._urlLock(url)
+        urlLock.acquire()
+        try:
+            entry = self._entries.get(url)
+            if entry == None or not self._isFresh(entry):
+                entry = self._readDisk(url)
+            if entry == None or not self._isFresh(entry):
+                try:
+                    rawKeys = self.fetch(url)
+                except Exception:
+                    log.exception("Could not fetch keys from %s", url)
+                    rawKeys = []
+                entry = {"url": url, "fetched": time.time(), "keys": rawKeys}
+                self._writeDisk(url, entry)
+            self._entries[url] = entry
+            return entry["keys"]
+        finally:
+            urlLock.release()
+
+    def _keysFor(self, locations):
+        # the first location that has any key wins, as before
+        for location in locations:
+            rawKeys = self.keys(location)
+            if len(rawKeys) > 0:
+                return rawKeys
+        return []
+
+    def resolve_many(self, locationLists):
+        '''
+        Imports the keys for a batch of documents, given the key_location list of
+        each, in a single import_keys call. Key blocks imported before are skipped.
+
+        Returns the number of keys imported.
+        '''
+        pending = []
+        digests = set()
+        for locations in locationLists:
+            for rawKey in self._keysFor(locations or []):
+                digest = hashlib.sha256(rawKey.encode("utf-8")).hexdigest()
+                self._lock.acquire()
+                try:
+                    if digest in self._imported or digest in digests:
+                        continue
+                finally:
+                    self._lock.release()
+                digests.add(digest)
+                pending.append(rawKey)
+
+        if len(pending) == 0:
+            return 0
+        result = self.gpg.import_keys("\n".join(pending))
+        # a block gpg could not import is offered again with the next batch
+        if result.fingerprints and not result.not_imported:
+            self._lock.acquire()
+            try:
+                self._imported.update(digests)
+            finally:
+                self._lock.release()
+        return result.imported
+
+    def resolve(self, locations):
+        '''
+        Imports the keys for one document, see resolve_many.
+        '''
+        return self.resolve_many([locations])
@@ -0,0 +1,173 @@
+'''
+Copyright 2011 SRI International
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+import Queue
+from cStringIO import StringIO
+
+REDIRECT_CODES = [301, 302, 303, 307]
+MAX_REDIRECTS = 5
+IDEMPOTENT_METHODS = ["GET", "HEAD"]
+
+class ConnectionPool(object):
+    '''
+    Keeps persistent (keep-alive) HTTP and HTTPS connections per host so that
+    repeated requests against the same server skip the TCP and TLS handshakes.
+
+    urlopen() mirrors urllib2.urlopen(): it accepts a URL or a urllib2.Request,
+    returns a file-like response and raises urllib2.HTTPError for non-2xx
+    responses, so callers can swap one for the other.
+
+    Params:
+        maxsize : number of idle connections kept open per host
+        timeout : default socket timeout in seconds
+    '''
+
+    def __init__(self, maxsize=4, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, key):
+        self._lock.acquire()
+        try:
+            if not self._pools.has_key(key):
+                self._pools[key] = Queue.LifoQueue(self.maxsize)
+            return self._pools[key]
+        finally:
+            self._lock.release()
+
+    def _new_connection(self, scheme, host, timeout):
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=timeout)
+        return httplib.HTTPConnection(host, timeout=timeout)
+
+    def _get_connection(self, scheme, host, timeout):
+        try:
+            conn = self._get_pool((scheme, host)).get_nowait()
+        except Queue.Empty:
+            return self._new_connection(scheme, host, timeout), False
+        # an idle connection keeps the timeout it was opened with otherwise
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _put_connection(self, scheme, host, conn):
+        try:
+            self._get_pool((scheme, host)).put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def close(self):
+        '''Closes every idle connection held by the pool.'''
+        self._lock.acquire()
+        try:
+            pools = self._pools.values()
+            self._pools = {}
+        finally:
+            self._lock.release()
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Queue.Empty:
+                    break
+
+    def _can_resend(self, method, sent, error):
+        # a request that may have reached the server is only sent again if
+        # doing so twice is harmless; others only when the server closed the
+        # idle connection before reading them (nothing sent, or no status line)
+        if method in IDEMPOTENT_METHODS:
+            return True
+        return not sent or isinstance(error, httplib.BadStatusLine)
+
+    def _request(self, method, url, data, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        conn, reused = self._get_connection(parts.scheme, parts.netloc, timeout)
+        sent = False
+        try:
+            conn.request(method, path, data, headers)
+            sent = True
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused or not self._can_resend(method, sent, e):
+                raise
+            # the server dropped an idle connection, retry once on a fresh one
+            conn = self._new_connection(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            except:
+                conn.close()
+                raise
+
+        try:
+            body = response.read()
+        except:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_connection(parts.scheme, parts.netloc, conn)
+
+        return response.status, response.reason, response.msg, body
+
+    def urlopen(self, req, data=None, timeout=None):
+        '''
+        Sends the request over a pooled connection.
+
+        Returns a file-like response object (see urllib.addinfourl)
+        Raises urllib2.HTTPError for responses other than 2xx
+        '''
+        if isinstance(req, basestring):
+            req = urllib2.Request(req)
+        if data is not None:
+            req.add_data(data)
+        if timeout is None:
+            timeout = self.timeout
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        if req.has_data():
+            headers.setdefault("Content-type", "application/x-www-form-urlencoded")
+
+        method = req.get_method()
+        url = req.get_full_url()
+        body = req.get_data()
+        for redirect in range(MAX_REDIRECTS + 1):
+            status, reason, msg, content = self._request(method, url, body, headers, timeout)
+            if status in REDIRECT_CODES and method in ["GET", "HEAD"] and msg.getheader("location"):
+                url = urlparse.urljoin(url, msg.getheader("location"))
+                continue
+            break
+
+        if status < 200 or status >= 300:
+            raise urllib2.HTTPError(url, status, reason, msg, StringIO(content))
+
+        response = urllib.addinfourl(StringIO(content), msg, url, status)
+        response.msg = reason
+        return response
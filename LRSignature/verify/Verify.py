@@ -20,23 +20,77 @@ Created on May 9, 2011
 from gnupg import GPG
 from LRSignature.sign.Sign import Sign_0_21
 from LRSignature.errors import *
-import types, re, copy, os, sys
+import types, re, copy, os, sys, shutil, tempfile, hashlib, threading
 import cStringIO
 
+# status lines that only frame the output of --verify-files
+VERIFY_FILES_FRAMING = ["FILE_START", "FILE_DONE", "NEWSIG"]
+
+LINE_BREAK = re.compile("\r\n|\r|\n")
+BEGIN_MESSAGE = re.compile("^-----BEGIN PGP (SIGNED ){0,1}MESSAGE-----$")
+ARMOR_HEADER = re.compile("^[^:]+: .+$")
+BEGIN_SIGNATURE = re.compile("^-----BEGIN PGP SIGNATURE-----$")
+
+def _iterLines(text):
+    # the lines of text, without copying the whole of it into a list
+    start = 0
+    for lineBreak in LINE_BREAK.finditer(text):
+        yield text[start:lineBreak.start()]
+        start = lineBreak.end()
+    yield text[start:]
+
+# files in the GnuPG home whose change means the keyring may have changed
+KEYRING_FILES = ["pubring.kbx", "pubring.gpg", "trustdb.gpg"]
+
 class Verify_0_21(Sign_0_21):
     '''
     classdocs
     '''
 
 
-    def __init__(self, gpgbin="/usr/local/bin/gpg", gnupgHome=os.path.expanduser(os.path.join("~", ".gnupg"))):
+    def __init__(self, gpgbin="/usr/local/bin/gpg", gnupgHome=os.path.expanduser(os.path.join("~", ".gnupg")), cache=None):
         '''
         Constructor
+        
+        cache is an optional LRSignature.verify.cache.VerifyCache; verify() and
+        verify_many() then reuse earlier outcomes for unchanged envelopes.
         '''
         self.gnupgHome = gnupgHome
         self.gpgbin = gpgbin
+        self.cache = cache
+        self._keyringStamp = None
+        self._keyringDigest = None
+        self._keyringLock = threading.Lock()
         Sign_0_21.__init__(self, privateKeyID=None, passphrase=None, gnupgHome=self.gnupgHome, gpgbin=self.gpgbin, publicKeyLocations=[])
+    
+    def _keyring_digest(self):
+        '''
+        Digest of the fingerprints in the keyring. gpg is only asked for the
+        fingerprints again when one of the KEYRING_FILES has changed.
+        '''
+        stamp = []
+        for name in KEYRING_FILES:
+            try:
+                st = os.stat(os.path.join(os.path.expanduser(self.gnupgHome), name))
+                stamp.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                stamp.append(None)
         
+        self._keyringLock.acquire()
+        try:
+            if stamp != self._keyringStamp:
+                fingerprints = sorted([key["fingerprint"] for key in self.gpg.list_keys()])
+                self._keyringDigest = hashlib.sha256(",".join(fingerprints)).hexdigest()
+                self._keyringStamp = stamp
+                self.cache.keyring_changed(self._keyringDigest)
+            return self._keyringDigest
+        finally:
+            self._keyringLock.release()
+    
+    def _cache_key(self, sigInfo, message, keyring):
+        signatureDigest = hashlib.sha256(sigInfo["signature"].encode("utf-8")).hexdigest()
+        return ":".join([signatureDigest, message, keyring])
+    
     
     def _getSignatureInfo(self, envelope={}):
             sigInfo = None
@@ -60,42 +114,61 @@ class Verify_0_21(Sign_0_21):
             return sigInfo
     
     def _extractHashFromSignature(self, signatureBlock=""):
+        '''
+        Returns the signed text of a clearsigned block, with its line breaks
+        removed. Walks the block once: skips up to and including the blank line
+        that ends the armor headers, then collects lines until the signature.
+        '''
+        lines = _iterLines(signatureBlock)
         
-        def removeHead(mesg=[]):
-            status = 0
-            mcopy = copy.deepcopy(mesg)
-            for line in mesg:
-                if re.match("^-----BEGIN PGP (SIGNED ){0,1}MESSAGE-----$", line) != None:
-                    status = 1
-                elif (status == 1 or status == 2) and re.match("^[^:]+: .+$", line) != None:
-                    status = 2
-                elif (status == 1 or status == 2) and line == "":
-                    status = 3
-                
-                mcopy.pop(0)
-                
-                if status == 3:
-                    break
-                
-            return mcopy
-
-        def removeTail(mesg=[]):
-            msgOnly = ""
-            for line in mesg:
-                if re.match("^-----BEGIN PGP SIGNATURE-----$", line):
-                    break
-                msgOnly += line
-            return msgOnly
-        
-        if sys.version_info > (2, 7): 
-            sig = re.split("\r\n|\r|\n", signatureBlock, flags=re.MULTILINE)
-        else:
-            sig = re.split("\r\n|\r|\n", signatureBlock)
-            
-        hash = removeTail(removeHead(sig))
+        status = 0
+        for line in lines:
+            if BEGIN_MESSAGE.match(line) != None:
+                status = 1
+            elif (status == 1 or status == 2) and ARMOR_HEADER.match(line) != None:
+                status = 2
+            elif (status == 1 or status == 2) and line == "":
+                break
+        
+        # carries on with the same iterator, after the header block
+        msgOnly = []
+        for line in lines:
+            if BEGIN_SIGNATURE.match(line) != None:
+                break
+            msgOnly.append(line)
         
-        return hash
+        return "".join(msgOnly)
         
+    def _get_and_verify_result(self, envelope, sigInfo, verified, message=None):
+        if verified.valid == True:
+            verifiedHash = self._extractHashFromSignature(sigInfo["signature"])
+            
+            if message == None:
+                message = self.get_message(envelope)
+            if message == verifiedHash:
+                return verified
+            else:
+                raise BadSignatureFormat("valid signature, envelope hash bad match.")
+        elif verified.valid == False and verified.status == 'no public key':
+            raise MissingPublicKey(message=verified.data, keyid=verified.key_id)
+        else:
+            raise BadSignatureFormat("invalid signature")
+    
+    def _verify_result(self, envelope, sigInfo, verified, message=None):
+        if verified.valid == True:
+            verifiedHash = self._extractHashFromSignature(sigInfo["signature"])
+            
+            if message == None:
+                message = self.get_message(envelope)
+            if message == verifiedHash:
+                return True
+            else:
+                return False
+        elif verified.valid == False and verified.status == 'no public key':
+            raise MissingPublicKey(message=verified.data, keyid=verified.key_id)
+        else:
+            return False
+    
     def get_and_verify(self, envelope):
         '''
         Get the OpenPGP validation info and Verify integrity of the provided envelope.
@@ -111,19 +184,8 @@ class Verify_0_21(Sign_0_21):
         sigInfo = self._getSignatureInfo(envelope)
         
         if sigInfo != None:
-
             verified = self.gpg.verify(sigInfo["signature"])
-            if verified.valid == True:
-                verifiedHash = self._extractHashFromSignature(sigInfo["signature"])
-                
-                if self.get_message(envelope) == verifiedHash:
-                    return verified
-                else:
-                    raise BadSignatureFormat("valid signature, envelope hash bad match.")
-            elif verified.valid == False and verified.status == 'no public key':
-                raise MissingPublicKey(message=verified.data, keyid=verified.key_id)
-            else:
-                raise BadSignatureFormat("invalid signature")
+            return self._get_and_verify_result(envelope, sigInfo, verified)
         return None
 
     def verify(self, envelope):
@@ -142,20 +204,136 @@ class Verify_0_21(Sign_0_21):
         sigInfo = self._getSignatureInfo(envelope)
         
         if sigInfo != None:
-
-            verified = self.gpg.verify(sigInfo["signature"])
-            if verified.valid == True:
-                verifiedHash = self._extractHashFromSignature(sigInfo["signature"])
-                
-                if self.get_message(envelope) == verifiedHash:
-                    return True
-                else:
-                    return False
-            elif verified.valid == False and verified.status == 'no public key':
-                raise MissingPublicKey(message=verified.data, keyid=verified.key_id)
-            else:
-                return False
+            if self.cache == None:
+                verified = self.gpg.verify(sigInfo["signature"])
+                return self._verify_result(envelope, sigInfo, verified)
+            
+            message = self.get_message(envelope)
+            keyring = self._keyring_digest()
+            key = self._cache_key(sigInfo, message, keyring)
+            result = self.cache.get(key)
+            if result == None:
+                verified = self.gpg.verify(sigInfo["signature"])
+                result = self._verify_result(envelope, sigInfo, verified, message)
+                self.cache.put(key, keyring, result)
+            return result
         return None
+    
+    def _new_verify_result(self):
+        verified = self.gpg.result_map['verify'](self.gpg)
+        verified.status = None
+        verified.data = ""
+        return verified
+    
+    def _verify_files(self, paths):
+        '''
+        Runs a single gpg --verify-files over paths.
+        
+        Returns a list with a gnupg.Verify object for each path gpg got to, in
+        order. gpg stops at the first bad signature, so the list may be shorter
+        than paths; its last entry is then the bad signature.
+        '''
+        args = ["--batch --verify-files"] + ['"%s"' % path for path in paths]
+        p = self.gpg._open_subprocess(args)
+        stdout, stderr = p.communicate("")
+        
+        results = []
+        for line in stderr.decode(self.gpg.encoding, "replace").splitlines():
+            if line[0:9] != "[GNUPG:] ":
+                continue
+            L = line[9:].rstrip().split(None, 1)
+            if len(L) == 0:
+                continue
+            keyword = L[0]
+            value = len(L) > 1 and L[1] or ""
+            if keyword == "FILE_START":
+                results.append(self._new_verify_result())
+            elif len(results) > 0 and keyword not in VERIFY_FILES_FRAMING:
+                try:
+                    results[-1].handle_status(keyword, value)
+                except ValueError:
+                    # status lines this version of gnupg.py does not know about
+                    pass
+        return results
+    
+    def _verify_signatures(self, signatures, batchSize):
+        '''
+        Checks every signature with as few gpg processes as possible.
+        
+        Returns a gnupg.Verify object per signature, in order.
+        '''
+        results = []
+        tmpdir = tempfile.mkdtemp(prefix="lrverify")
+        try:
+            paths = []
+            for idx, signature in enumerate(signatures):
+                path = os.path.join(tmpdir, "{0}.asc".format(idx))
+                with open(path, "wb") as f:
+                    f.write(signature.encode("utf-8"))
+                paths.append(path)
+            
+            while len(results) < len(paths):
+                batch = self._verify_files(paths[len(results):len(results) + batchSize])
+                if len(batch) == 0:
+                    # gpg without --verify-files framing, check this one on its own
+                    batch = [self.gpg.verify(signatures[len(results)])]
+                results.extend(batch)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return results
+    
+    def _verify_many(self, envelopes, check, batchSize, useCache=False):
+        results = [None] * len(envelopes)
+        signed = []
+        keys = {}
+        messages = {}
+        if useCache:
+            keyring = self._keyring_digest()
+        for idx, envelope in enumerate(envelopes):
+            try:
+                sigInfo = self._getSignatureInfo(envelope)
+                if sigInfo == None:
+                    continue
+                if useCache:
+                    messages[idx] = self.get_message(envelope)
+                    keys[idx] = self._cache_key(sigInfo, messages[idx], keyring)
+                    cached = self.cache.get(keys[idx])
+                    if cached != None:
+                        results[idx] = cached
+                        continue
+                signed.append((idx, sigInfo))
+            except Exception as e:
+                results[idx] = e
+        
+        verified = self._verify_signatures([sigInfo["signature"] for idx, sigInfo in signed], batchSize)
+        for (idx, sigInfo), verifiedSig in zip(signed, verified):
+            try:
+                results[idx] = check(envelopes[idx], sigInfo, verifiedSig, messages.get(idx))
+                if useCache:
+                    self.cache.put(keys[idx], keyring, results[idx])
+            except Exception as e:
+                results[idx] = e
+        return results
+    
+    def verify_many(self, envelopes, batchSize=500):
+        '''
+        Verify integrity of a list of envelopes, running one gpg process for up
+        to batchSize signatures instead of one per envelope.
+        
+        Returns a list in the order of envelopes, holding for each envelope
+        what verify() would return, or the exception verify() would raise
+        (e.g. MissingPublicKey).
+        '''
+        return self._verify_many(envelopes, self._verify_result, batchSize, useCache=self.cache != None)
+    
+    def get_and_verify_many(self, envelopes, batchSize=500):
+        '''
+        Batch version of get_and_verify(), see verify_many().
+        
+        Returns a list in the order of envelopes, holding for each envelope
+        what get_and_verify() would return or the exception it would raise.
+        '''
+        return self._verify_many(envelopes, self._get_and_verify_result, batchSize)
 
 if __name__ == "__main__":
     verify = Verify_0_21()
@@ -14,5 +14,6 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 import Verify
+import cache
 
-__all__ = ["Verify"]
\ No newline at end of file
+__all__ = ["Verify", "cache"]
\ No newline at end of file
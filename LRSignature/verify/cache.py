@@ -0,0 +1,98 @@
+'''
+Copyright 2011 SRI International
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import sqlite3
+import threading
+import time
+
+class VerifyCache(object):
+    '''
+    Persistent store of earlier verification outcomes (True or False), kept in
+    a sqlite file so periodic re-audits can skip envelopes that were already
+    checked against the same keyring.
+
+    Entries are keyed by Verify_0_21 on the signature block digest, the
+    canonical envelope hash and the keyring fingerprints. Each entry also
+    records the keyring it was checked against; when the keyring changes the
+    entries for every other keyring are dropped. Beyond maxEntries the least
+    recently used entries are evicted.
+
+    Params:
+        path : sqlite file to keep the cache in (":memory:" for a private one)
+        maxEntries : number of outcomes kept
+    '''
+
+    def __init__(self, path, maxEntries=100000):
+        self.maxEntries = maxEntries
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.lock.acquire()
+        try:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS verified (key TEXT PRIMARY KEY, keyring TEXT, result INTEGER, accessed REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS verified_accessed ON verified (accessed)")
+            self.conn.commit()
+            self.size = self.conn.execute("SELECT COUNT(*) FROM verified").fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        '''
+        Returns the stored outcome for key, or None if there is none.
+        '''
+        self.lock.acquire()
+        try:
+            row = self.conn.execute("SELECT result FROM verified WHERE key = ?", (key,)).fetchone()
+            if row == None:
+                return None
+            self.conn.execute("UPDATE verified SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0] == 1
+        finally:
+            self.lock.release()
+
+    def put(self, key, keyring, result):
+        self.lock.acquire()
+        try:
+            existing = self.conn.execute("SELECT 1 FROM verified WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO verified (key, keyring, result, accessed) VALUES (?, ?, ?, ?)",
+                (key, keyring, result and 1 or 0, time.time()))
+            if existing == None:
+                self.size += 1
+            if self.size > self.maxEntries:
+                excess = self.size - self.maxEntries
+                self.conn.execute("DELETE FROM verified WHERE key IN (SELECT key FROM verified ORDER BY accessed LIMIT ?)", (excess,))
+                self.size -= excess
+            self.conn.commit()
+        finally:
+            self.lock.release()
+
+    def keyring_changed(self, keyring):
+        '''
+        Drops every outcome that was not checked against keyring.
+        '''
+        self.lock.acquire()
+        try:
+            self.conn.execute("DELETE FROM verified WHERE keyring != ?", (keyring,))
+            self.conn.commit()
+            self.size = self.conn.execute("SELECT COUNT(*) FROM verified").fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.conn.close()
+        finally:
+            self.lock.release()
@@ -42,9 +42,11 @@ except ImportError:
     from cStringIO import StringIO
 
 import codecs
+import errno
 import locale
 import logging
 import os
+import select
 import socket
 from subprocess import Popen
 from subprocess import PIPE
@@ -95,6 +97,10 @@ def _copy_data(instream, outstream):
         logger.warning('Exception occurred while closing: ignored', exc_info=1)
     logger.debug("closed output, %d bytes sent", sent)
 
+# Pipes can be polled on POSIX only; elsewhere a thread serves each stream.
+_MULTIPLEX_IO = os.name == 'posix'
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
 def _threaded_copy_data(instream, outstream):
     wr = threading.Thread(target=_copy_data, args=(instream, outstream))
     wr.setDaemon(True)
@@ -520,22 +526,25 @@ class GPG(object):
             if len(line) == 0:
                 break
             lines.append(line)
-            line = line.rstrip()
-            if self.verbose:
-                print(line)
-            logger.debug("%s", line)
-            if line[0:9] == '[GNUPG:] ':
-                # Chop off the prefix
-                line = line[9:]
-                L = line.split(None, 1)
-                keyword = L[0]
-                if len(L) > 1:
-                    value = L[1]
-                else:
-                    value = ""
-                result.handle_status(keyword, value)
+            self._handle_status_line(line, result)
         result.stderr = ''.join(lines)
 
+    def _handle_status_line(self, line, result):
+        line = line.rstrip()
+        if self.verbose:
+            print(line)
+        logger.debug("%s", line)
+        if line[0:9] == '[GNUPG:] ':
+            # Chop off the prefix
+            line = line[9:]
+            L = line.split(None, 1)
+            keyword = L[0]
+            if len(L) > 1:
+                value = L[1]
+            else:
+                value = ""
+            result.handle_status(keyword, value)
+
     def _read_data(self, stream, result):
         # Read the contents of the file from GPG's stdout
         chunks = []
@@ -551,13 +560,34 @@ class GPG(object):
         else:
             result.data = ''.join(chunks)
 
-    def _collect_output(self, process, result, writer=None, stdin=None):
+    def _collect_output(self, process, result, writer=None, stdin=None,
+                        input=None):
         """
         Drain the subprocesses output streams, writing the collected output
-        to the result. If a writer thread (writing to the subprocess) is given,
+        to the result. If an input file is given, copy it to the subprocess'
+        stdin. If a writer thread (writing to the subprocess) is given,
         make sure it's joined before returning. If a stdin stream is given,
         close it before returning.
         """
+        if _MULTIPLEX_IO:
+            self._multiplex_output(process, result, input)
+        else:
+            if input is not None:
+                writer = _threaded_copy_data(input, stdin)
+            self._threaded_output(process, result)
+        if writer is not None:
+            writer.join()
+        process.wait()
+        if stdin is not None:
+            try:
+                stdin.close()
+            except IOError:
+                pass
+        process.stderr.close()
+        process.stdout.close()
+
+    def _threaded_output(self, process, result):
+        # Internal method: a thread each for stderr and stdout
         stderr = codecs.getreader(self.encoding)(process.stderr)
         rr = threading.Thread(target=self._read_response, args=(stderr, result))
         rr.setDaemon(True)
@@ -572,16 +602,124 @@ class GPG(object):
 
         dr.join()
         rr.join()
-        if writer is not None:
-            writer.join()
-        process.wait()
-        if stdin is not None:
-            try:
-                stdin.close()
-            except IOError:
+
+    def _multiplex_output(self, process, result, input=None):
+        # Internal method: serves stdin, stdout and the status stream from
+        # the calling thread, waiting on them with poll (or select).
+        # Same results as _threaded_output and _copy_data, without starting
+        # a thread per stream for every gpg call.
+        stdout = process.stdout.fileno()
+        stderr = process.stderr.fileno()
+        readers = [stdout, stderr]
+        writers = []
+        pending = ''
+        if input is not None:
+            # a passphrase may be waiting in the buffer of the stdin file
+            # object; it has to reach gpg before the data written to the fd
+            process.stdin.flush()
+            writers.append(process.stdin.fileno())
+        chunks = []
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        partial = []
+        lines = []
+        handled = 0
+        handling = True
+        sent = 0
+
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in readers:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            for fd in writers:
+                poller.register(fd, select.POLLOUT)
+            def wait():
+                ready = []
+                for fd, mode in poller.poll():
+                    if fd in writers and mode & (select.POLLOUT | select.POLLERR | select.POLLHUP):
+                        ready.append(fd)
+                    elif fd in readers:
+                        ready.append(fd)
+                return ready
+            def unregister(fd):
+                poller.unregister(fd)
+        else:
+            def wait():
+                rlist, wlist, xlist = select.select(readers, writers, [])
+                return wlist + rlist
+            def unregister(fd):
                 pass
-        stderr.close()
-        stdout.close()
+
+        while readers or writers:
+            try:
+                ready = wait()
+            except (select.error, IOError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                if fd in writers:
+                    if len(pending) == 0:
+                        pending = input.read(_PIPE_BUF)
+                        if not _py3k and type(pending) is not str:
+                            pending = pending.encode(self.encoding)
+                    try:
+                        if len(pending) == 0:
+                            raise EOFError
+                        written = os.write(fd, pending[:_PIPE_BUF])
+                        sent += written
+                        logger.debug("sending chunk (%d): %r", sent, pending[:min(written, 256)])
+                        pending = pending[written:]
+                    except (EOFError, OSError) as e:
+                        if isinstance(e, OSError):
+                            if e.errno == errno.EINTR:
+                                continue
+                            # gpg may stop reading early, e.g. on a bad passphrase
+                            logger.exception('Error sending data')
+                        unregister(fd)
+                        writers.remove(fd)
+                        try:
+                            process.stdin.close()
+                        except IOError:
+                            logger.warning('Exception occurred while closing: ignored', exc_info=1)
+                        logger.debug("closed output, %d bytes sent", sent)
+                    continue
+                try:
+                    data = os.read(fd, 1024)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if len(data) == 0:
+                    unregister(fd)
+                    readers.remove(fd)
+                    if fd == stderr:
+                        data = decoder.decode('', True)
+                    else:
+                        continue
+                elif fd == stdout:
+                    logger.debug("chunk: %r" % data[:256])
+                    chunks.append(data)
+                    continue
+                else:
+                    data = decoder.decode(data)
+                # status lines, handled as soon as they are complete
+                for piece in data.splitlines(True):
+                    partial.append(piece)
+                    if piece.endswith('\n'):
+                        lines.append(''.join(partial))
+                        partial = []
+                if fd not in readers and len(partial) > 0:
+                    lines.append(''.join(partial))
+                while handled < len(lines) and handling:
+                    try:
+                        self._handle_status_line(lines[handled], result)
+                    except Exception:
+                        # the threaded reader stops at the first error too
+                        logger.exception('Error handling status line')
+                        handling = False
+                    handled += 1
+        result.data = ''.join(chunks)
+        result.stderr = ''.join(lines)
 
     def _handle_io(self, args, file, result, passphrase=None, binary=False):
         "Handle a call to GPG - pass input data, collect output data"
@@ -594,8 +732,7 @@ class GPG(object):
             stdin = p.stdin
         if passphrase:
             _write_passphrase(stdin, passphrase, self.encoding)
-        writer = _threaded_copy_data(file, stdin)
-        self._collect_output(p, result, writer, stdin)
+        self._collect_output(p, result, stdin=stdin, input=file)
         return result
 
     #
@@ -628,15 +765,14 @@ class GPG(object):
         #We could use _handle_io here except for the fact that if the
         #passphrase is bad, gpg bails and you can't write the message.
         p = self._open_subprocess(args, passphrase is not None)
+        stdin = p.stdin
         try:
-            stdin = p.stdin
             if passphrase:
                 _write_passphrase(stdin, passphrase, self.encoding)
-            writer = _threaded_copy_data(file, stdin)
         except IOError:
             logging.exception("error writing message")
-            writer = None
-        self._collect_output(p, result, writer, stdin)
+            file = None
+        self._collect_output(p, result, stdin=stdin, input=file)
         return result
 
     def verify(self, data):
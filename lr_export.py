@@ -1,4 +1,9 @@
-import ConfigParser, datetime, hashlib, json, logging, LRSignature, os, sys, traceback, urllib, urllib2, base64
+import ConfigParser, datetime, hashlib, json, logging, LRSignature, os, Queue, shutil, socket, sqlite3, sys, threading, time, traceback, urllib, urllib2, base64
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from LRSignature.util.pool import ConnectionPool
+from LRSignature.util.batch import AdaptiveBatcher
+from LRSignature.util.jsonstream import gzipDocuments, refusesGzip
 from xml.sax.saxutils import escape
 APP_NAME="lr_export"
 LOG_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
@@ -6,21 +11,381 @@ LOG_DATE_FORMAT = "%Y-%m-%d %I:%M:%S %p"
 LOG_FILENAME_FORMAT = APP_NAME + "-%Y%m%d%H%M%S" + '.log'
 API_DATE = '%m%d%Y'
 SHORT_DATE = "%Y-%m-%d"
+STATE_DATE = "%Y-%m-%d %H:%M:%S"
+DEFAULT_START_DATE = datetime.datetime(2002, 01, 01)
 LANGUAGE_CODES = {'English US':'eng', 'Spanish':'spa', 'Bulgarian':'bul', 'Arabic':'ara', 'Afrikaans':'afr', 'Cantonese':'yue', 'Chinese':'chi', 'Czech':'ces', 'Danish':'dan', 'Dutch':'dut', 'French':'fre', 'German':'ger', 'Gujarati':'guj', 'Hebrew':'heb', 'Hindi':'hin', 'Italian':'ita', 'Japanese':'jpn', 'Malayalam':'mal', 'Mandarin':'cmn', 'Marathi':'mar', 'Panjabi':'pan', 'Russian':'rus', 'Swedish':'sve', 'Tamil':'tam', 'Telugu':'tel', 'Turkish':'tur', 'Latin':'lat', 'Bengali':'ben', 'Portuguese':'por', 'Javanese':'jav', 'Korean':'kor', 'Vietnamese':'vie', 'Urdu':'urd', 'English Great Britain':'eng'}
 CATEGORIES = ['Educational Materials', 'Textbooks']
+END_OF_STREAM = object()
+
+# parts of every envelope and JSON-LD payload that never change. They are shared,
+# not copied, so the signer can reuse their canonical form (see getSigner).
+# Do not modify them.
+ENVELOPE_TOS = {"submission_TOS": "http://www.learningregistry.org/tos/cc0/v0-5/"}
+ENVELOPE_IDENTITY = {
+    "submitter": "Bookshare.org",
+    "signer": "Bookshare.org",
+    "submitter_type": "agent"
+}
+ENVELOPE_PAYLOAD_SCHEMA = ["json", "json-ld", "schema.org", "lrmi"]
+JSONLD_CONTEXT = {
+    "@vocab": "http://schema.org/",
+    "lrmi": "http://lrmi.net/the-specification#",
+    "useRightsUrl": {
+        "@id": "lrmi:useRightsUrl",
+        "@type": "@id"
+    }
+}
+JSONLD_PROVIDER = {
+    "@type": "http://schema.org/Organization",
+    "name": "Bookshare.org"
+}
+JSONLD_AUDIENCE = {
+    "@type": "http://schema.org/EducationalAudience",
+    "educationalRole": "student"
+}
+JSONLD_ACCESSIBILITY_FEATURE = [
+    "displayTransformability/font-size",
+    "displayTransformability/font-family",
+    "displayTransformability/color",
+    "displayTransformability/background-color",
+    "bookmarks",
+    "readingOrder",
+    "structuralNavigation"
+]
+JSONLD_ACCESSIBILITY_HAZARD = [
+    "noFlashingHazard",
+    "noMotionSimulationHazard",
+    "noSoundHazard"
+]
+JSONLD_ACCESSIBILITY_CONTROL = [
+    "fullKeyboardControl",
+    "fullMouseControl"
+]
+SHARED_CONSTANTS = [ENVELOPE_TOS, ENVELOPE_IDENTITY, ENVELOPE_PAYLOAD_SCHEMA, JSONLD_CONTEXT, JSONLD_PROVIDER, JSONLD_AUDIENCE,
+    JSONLD_ACCESSIBILITY_FEATURE, JSONLD_ACCESSIBILITY_HAZARD, JSONLD_ACCESSIBILITY_CONTROL]
+
+connectionPool = None
+# set once the node has refused a gzip compressed publish body
+gzipRefused = False
+stateDb = None
 
 def readConfig():
     config = ConfigParser.SafeConfigParser()
     config.read(APP_NAME + ".conf")
     return config
 
+def getOption(config, section, option, default):
+    # optional settings fall back to a default so older config files keep working
+    if config.has_option(section, option) and len(config.get(section, option).strip()) > 0:
+        return config.get(section, option)
+    return default
+
+def getIntOption(config, section, option, default):
+    value = getOption(config, section, option, None)
+    if value == None:
+        return default
+    return int(value)
+
+def getPublishBatcher(config):
+    # publish_batch_size caps the documents in a batch, publish_batch_bytes
+    # (if set) their serialized size
+    maxBytes = getIntOption(config, 'Main', 'publish_batch_bytes', 0) or None
+    return AdaptiveBatcher(maxBytes=maxBytes, maxDocuments=int(config.get('Main', 'publish_batch_size')))
+
+def getPublishGzip(config):
+    if gzipRefused or not config.has_option('Learning Registry', 'publish_gzip'):
+        return False
+    return config.get('Learning Registry', 'publish_gzip').strip().lower() in ["true", "yes", "t", "y", "1"]
+
+def getConnectionPool(config):
+    # one keep-alive pool per process, shared by search, detail and publish requests
+    global connectionPool
+    if connectionPool == None:
+        connectionPool = ConnectionPool(maxsize=getIntOption(config, 'Main', 'http_pool_size', 4))
+    return connectionPool
+
+def getStateDb(config):
+    # all persistent local state lives in one sqlite file next to the config
+    global stateDb
+    if stateDb == None:
+        path = APP_NAME + ".db"
+        if config.has_option('Main', 'state_path') and len(config.get('Main', 'state_path').strip()) > 0:
+            path = config.get('Main', 'state_path')
+        if path != ":memory:":
+            path = os.path.realpath(path)
+        stateDb = StateDb(path)
+    return stateDb
+
+class StateDb(object):
+    # thread-safe wrapper around a single sqlite connection
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+    def execute(self, sql, params=(), commit=True):
+        self.lock.acquire()
+        try:
+            rows = self.conn.execute(sql, params).fetchall()
+            if commit:
+                self.conn.commit()
+            return rows
+        finally:
+            self.lock.release()
+
+    def transaction(self, statements):
+        # runs a list of (sql, params) pairs atomically
+        self.lock.acquire()
+        try:
+            try:
+                for sql, params in statements:
+                    self.conn.execute(sql, params)
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        finally:
+            self.lock.release()
+
+class CachedBook(object):
+    def __init__(self, data, etag, lastModified, fetched):
+        self.data = data
+        self.etag = etag
+        self.lastModified = lastModified
+        self.fetched = fetched
+
+class BookCache(object):
+    # detail records keyed by Bookshare book id. Entries younger than ttl
+    # seconds are used as is; older ones are revalidated with the ETag or
+    # Last-Modified validators the API sent, or refetched if there were none.
+    # The least recently used entries are evicted beyond maxEntries. Access
+    # times are kept in memory and written flushEvery reads at a time, so a
+    # cache hit costs no commit of its own.
+    def __init__(self, db, ttl=86400, maxEntries=100000, flushEvery=100):
+        self.db = db
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.flushEvery = flushEvery
+        self.accessed = {}
+        self.db.execute("CREATE TABLE IF NOT EXISTS book_cache (book_id INTEGER PRIMARY KEY, data TEXT, etag TEXT, last_modified TEXT, fetched REAL, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS book_cache_accessed ON book_cache (accessed)")
+        self.size = self.db.execute("SELECT COUNT(*) FROM book_cache")[0][0]
+
+    def get(self, bookId):
+        rows = self.db.execute("SELECT data, etag, last_modified, fetched FROM book_cache WHERE book_id = ?", (bookId,), commit=False)
+        if len(rows) == 0:
+            return None
+        data, etag, lastModified, fetched = rows[0]
+        self.db.lock.acquire()
+        try:
+            self.accessed[bookId] = time.time()
+            if len(self.accessed) >= self.flushEvery:
+                self.flush()
+        finally:
+            self.db.lock.release()
+        return CachedBook(json.loads(data), etag, lastModified, fetched)
+
+    def flush(self):
+        # writes the pending access times in one transaction
+        self.db.lock.acquire()
+        try:
+            if len(self.accessed) == 0:
+                return
+            accessed = self.accessed
+            self.accessed = {}
+            self.db.transaction([("UPDATE book_cache SET accessed = ? WHERE book_id = ?", (when, bookId)) for bookId, when in accessed.items()])
+        finally:
+            self.db.lock.release()
+
+    def isFresh(self, entry):
+        return time.time() - entry.fetched < self.ttl
+
+    def touch(self, bookId):
+        # a successful revalidation restarts the ttl
+        now = time.time()
+        self.db.execute("UPDATE book_cache SET fetched = ?, accessed = ? WHERE book_id = ?", (now, now, bookId))
+
+    def put(self, bookId, data, etag=None, lastModified=None):
+        now = time.time()
+        self.db.lock.acquire()
+        try:
+            # eviction goes by access time, so it must see the pending ones
+            self.flush()
+            existing = self.db.execute("SELECT 1 FROM book_cache WHERE book_id = ?", (bookId,), commit=False)
+            self.db.execute("INSERT OR REPLACE INTO book_cache (book_id, data, etag, last_modified, fetched, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (bookId, json.dumps(data), etag, lastModified, now, now))
+            if len(existing) == 0:
+                self.size += 1
+            if self.size > self.maxEntries:
+                excess = self.size - self.maxEntries
+                self.db.execute("DELETE FROM book_cache WHERE book_id IN (SELECT book_id FROM book_cache ORDER BY accessed LIMIT ?)", (excess,))
+                self.size -= excess
+        finally:
+            self.db.lock.release()
+
+class PublishIndex(object):
+    # resource_locator -> content hash of the last JSON-LD payload the node
+    # accepted for it, and the doc_ID it was given
+    def __init__(self, db):
+        self.db = db
+        self.db.execute("CREATE TABLE IF NOT EXISTS published (resource_locator TEXT PRIMARY KEY, content_hash TEXT, doc_id TEXT, published REAL)")
+
+    def isCurrent(self, locator, contentHash):
+        rows = self.db.execute("SELECT content_hash FROM published WHERE resource_locator = ?", (locator,), commit=False)
+        return len(rows) > 0 and rows[0][0] == contentHash
+
+    def record(self, locator, contentHash, docId):
+        self.db.execute("INSERT OR REPLACE INTO published (resource_locator, content_hash, doc_id, published) VALUES (?, ?, ?, ?)",
+            (locator, contentHash, docId, time.time()))
+
+def getPublishIndex(config):
+    return PublishIndex(getStateDb(config))
+
+def contentHash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True)).hexdigest()
+
+class CrawlPosition(object):
+    # the next search page to fetch, plus the book ids fetched since the
+    # previous position
+    def __init__(self, category, page, fetchedIds):
+        self.category = category
+        self.page = page
+        self.fetchedIds = fetchedIds
+
+class CrawlCheckpoint(object):
+    # progress of an unfinished run, so a restart can pick up where it died.
+    # The ids of the books already fetched are kept a row each, so saving a
+    # page only writes the ids that page added.
+    def __init__(self, db):
+        self.db = db
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY, run_id INTEGER, category TEXT, page INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoint_ids (book_id INTEGER PRIMARY KEY)")
+
+    def load(self):
+        # returns (runId, CrawlPosition) with every id fetched so far, or
+        # (None, None) without a checkpoint
+        rows = self.db.execute("SELECT run_id, category, page FROM checkpoint WHERE id = 1", commit=False)
+        if len(rows) == 0:
+            return None, None
+        runId, category, page = rows[0]
+        fetchedIds = [bookId for (bookId,) in self.db.execute("SELECT book_id FROM checkpoint_ids", commit=False)]
+        return runId, CrawlPosition(category, page, fetchedIds)
+
+    def save(self, run, position):
+        # position.fetchedIds are the ids fetched since the last saved position
+        statements = [("INSERT OR REPLACE INTO checkpoint (id, run_id, category, page) VALUES (1, ?, ?, ?)",
+            (run.runId, position.category, position.page))]
+        for bookId in position.fetchedIds:
+            statements.append(("INSERT OR IGNORE INTO checkpoint_ids (book_id) VALUES (?)", (bookId,)))
+        self.db.transaction(statements)
+
+    def clear(self):
+        self.db.transaction([("DELETE FROM checkpoint", ()), ("DELETE FROM checkpoint_ids", ())])
+
+def getCrawlCheckpoint(config):
+    return CrawlCheckpoint(getStateDb(config))
+
+class Run(object):
+    def __init__(self, runId, started, sinceDates):
+        self.runId = runId
+        self.started = started
+        self.sinceDates = sinceDates
+
+class RunState(object):
+    # run history and the per-category high-water marks. A mark only moves
+    # when a run completes, and then to the time that run started, so books
+    # added while a run was in progress are picked up by the next one.
+    def __init__(self, db):
+        self.db = db
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, finished TEXT, status TEXT, since_dates TEXT, books INTEGER, published INTEGER, unchanged INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS watermarks (category TEXT PRIMARY KEY, since TEXT)")
+
+    def getWatermarks(self):
+        rows = self.db.execute("SELECT category, since FROM watermarks", commit=False)
+        return dict([(category, datetime.datetime.strptime(since, STATE_DATE)) for category, since in rows])
+
+    def getFirstRunDates(self):
+        rows = self.db.execute("SELECT since_dates FROM runs ORDER BY id LIMIT 1", commit=False)
+        if len(rows) == 0:
+            return None
+        return self._decodeDates(rows[0][0])
+
+    def startRun(self, sinceDates):
+        started = datetime.datetime.now().replace(microsecond=0)
+        self.db.lock.acquire()
+        try:
+            self.db.execute("INSERT INTO runs (started, status, since_dates) VALUES (?, 'running', ?)",
+                (started.strftime(STATE_DATE), self._encodeDates(sinceDates)))
+            runId = self.db.execute("SELECT last_insert_rowid()", commit=False)[0][0]
+        finally:
+            self.db.lock.release()
+        return Run(runId, started, sinceDates)
+
+    def resumeRun(self, runId):
+        rows = self.db.execute("SELECT started, since_dates FROM runs WHERE id = ?", (runId,), commit=False)
+        if len(rows) == 0:
+            return None
+        self.db.execute("UPDATE runs SET status = 'running' WHERE id = ?", (runId,))
+        started, sinceDates = rows[0]
+        return Run(runId, datetime.datetime.strptime(started, STATE_DATE), self._decodeDates(sinceDates))
+
+    def finishRun(self, run, status, result=None):
+        finished = datetime.datetime.now().strftime(STATE_DATE)
+        statements = []
+        if result != None:
+            statements.append(("UPDATE runs SET finished = ?, status = ?, books = ?, published = ?, unchanged = ? WHERE id = ?",
+                (finished, status, result.books, result.published, result.unchanged, run.runId)))
+        else:
+            statements.append(("UPDATE runs SET finished = ?, status = ? WHERE id = ?", (finished, status, run.runId)))
+        if status == "completed":
+            for category in run.sinceDates.keys():
+                statements.append(("INSERT OR REPLACE INTO watermarks (category, since) VALUES (?, ?)",
+                    (category, run.started.strftime(STATE_DATE))))
+        self.db.transaction(statements)
+
+    def _encodeDates(self, dates):
+        return json.dumps(dict([(category, date.strftime(STATE_DATE)) for category, date in dates.items()]))
+
+    def _decodeDates(self, encoded):
+        return dict([(category, datetime.datetime.strptime(date, STATE_DATE)) for category, date in json.loads(encoded).items()])
+
+def getRunState(config):
+    return RunState(getStateDb(config))
+
+def getBookCache(config):
+    ttl = getIntOption(config, 'Cache', 'ttl', 86400)
+    maxEntries = getIntOption(config, 'Cache', 'max_entries', 100000)
+    if maxEntries <= 0:
+        return None
+    return BookCache(getStateDb(config), ttl, maxEntries)
+
 def initLogging(config):
     logName = datetime.datetime.today().strftime(LOG_FILENAME_FORMAT)
     logPath = os.path.realpath(config.get('Main', 'log_path'))
     logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT, filename=os.path.join(logPath, logName), filemode='w', level=logging.INFO)
     logging.info("Job started.")
 
-def getLastRunDate(config):
+def getLastRunDates(config):
+    # per-category date to search from: the category's high-water mark, or a
+    # sensible default for categories that have never completed a run
+    runState = getRunState(config)
+    marks = runState.getWatermarks()
+    if len(marks) == 0:
+        # no run has completed yet: start where the first recorded run did.
+        # Only with no runs at all is this an install from before the state
+        # file, to carry on from the old log-based date; later log files were
+        # written by the recorded runs themselves.
+        marks = runState.getFirstRunDates()
+        if marks == None:
+            marks = {}
+            lastRun = _getLastLogDate(config)
+            if lastRun != None:
+                marks = dict([(category, lastRun) for category in CATEGORIES])
+    sinceDates = {}
+    for category in CATEGORIES:
+        sinceDates[category] = marks.get(category, DEFAULT_START_DATE)
+    return sinceDates
+
+def _getLastLogDate(config):
     logFiles = os.listdir(os.path.realpath(config.get('Main', 'log_path')))
     try:
         if len(logFiles) > 0:
@@ -28,11 +393,19 @@ def getLastRunDate(config):
             return datetime.datetime.strptime(logFiles[-1], LOG_FILENAME_FORMAT)
     except:
         pass
-    
-    # sensible default
-    return datetime.datetime(2002, 01, 01)
+    return None
+
+def fetchBooks(config, sinceDates, resumeFrom=None):
+    result = {}
+    for bookId, data in iterBooks(config, sinceDates, resumeFrom):
+        result[bookId] = data
+    return result
 
-def fetchBooks(config, startDate):
+def iterBooks(config, sinceDates, resumeFrom=None, onPage=None):
+    # yields (bookId, metadata) pairs as soon as each detail record arrives,
+    # so callers never need to hold the whole result set in memory.
+    # resumeFrom is a CrawlPosition to continue from; onPage is called with
+    # the CrawlPosition reached after each search page.
     # prepare all the bits!
     safe_username=urllib.quote_plus(config.get('Bookshare', 'username'), safe='/') #take care of spaces and special chars
     password_hash=urllib.quote(hashlib.md5(config.get('Bookshare', 'password')).hexdigest())
@@ -40,89 +413,154 @@ def fetchBooks(config, startDate):
     api_key = config.get('Bookshare', 'api_key')
     api_host = config.get('Bookshare', 'api_host')
     
-    result = {}
+    seen = set()
+    # fetched since the last CrawlPosition
+    fetchedIds = []
+    categories = CATEGORIES
+    firstPage = 1
+    if resumeFrom != None:
+        seen.update(resumeFrom.fetchedIds)
+        categories = CATEGORIES[CATEGORIES.index(resumeFrom.category):]
+        firstPage = resumeFrom.page
     
     search_url = "https://%s/book/search/category/%s/since/%s/limit/250/page/%d/format/json/for/%s?api_key=%s"
     detail_url = "https://%s/book/id/%d/format/json/for/%s?api_key=%s"
-    
-    for category in CATEGORIES:
-        page = 1
-        while page > 0:
-
-            retry = 0
-            searchResponse = None
-
-            url = search_url % (api_host, urllib.quote(category), startDate.strftime(API_DATE), page, safe_username, api_key)
-            logUrl=url.split("?")[0] #don't log the api key, so remove everything after the question mark
-            logging.info("Retrieving booklist of books since " + startDate.strftime(SHORT_DATE) + " from " + logUrl)
-            req=urllib2.Request(url, headers=password_header)
-
-            while (searchResponse == None and retry < 3):
-                try:
-                    conn = urllib2.urlopen(req)
-                    res=conn.read()
-                    conn.close()
-
-                    #pythonize json gotten from reading the url response
-                    searchResponse=json.loads(res) 
-                    root=searchResponse["bookshare"]
-                    numPages = int(root["book"]["list"]["numPages"])
-
-                    #for every book in the booklist, request its metadata using its id:
-                    for book in root["book"]["list"]["result"]:
-                        bookId=book['id']
-                        
-                        if (result.has_key(bookId) == True):
-                            logging.info("Title \"" + book["title"] + "\" already exists in result set. Skipping metadata fetch.")
+
+    connections = getConnectionPool(config)
+    cache = getBookCache(config)
+
+    def fetch(item):
+        bookId, bookReq = item
+        return fetchBookData(bookReq, connections, cache, bookId)
+
+    workers = getIntOption(config, 'Main', 'fetch_workers', 1)
+    pool = None
+    if workers > 1:
+        pool = ThreadPool(workers)
+
+    try:
+        for category in categories:
+            page = firstPage
+            firstPage = 1
+            startDate = sinceDates[category]
+            while page > 0:
+
+                retry = 0
+                searchResponse = None
+
+                url = search_url % (api_host, urllib.quote(category), startDate.strftime(API_DATE), page, safe_username, api_key)
+                logUrl=url.split("?")[0] #don't log the api key, so remove everything after the question mark
+                logging.info("Retrieving booklist of books since " + startDate.strftime(SHORT_DATE) + " from " + logUrl)
+                req=urllib2.Request(url, headers=password_header)
+
+                while (searchResponse == None and retry < 3):
+                    try:
+                        conn = connections.urlopen(req)
+                        res=conn.read()
+                        conn.close()
+
+                        #pythonize json gotten from reading the url response
+                        searchResponse=json.loads(res) 
+                        root=searchResponse["bookshare"]
+                        numPages = int(root["book"]["list"]["numPages"])
+
+                        #for every book in the booklist, request its metadata using its id:
+                        pending = []
+                        pendingIds = set()
+                        for book in root["book"]["list"]["result"]:
+                            bookId=book['id']
+                            
+                            if (bookId in seen or bookId in pendingIds):
+                                logging.info("Title \"" + book["title"] + "\" already exists in result set. Skipping metadata fetch.")
+                            else:
+                                url=detail_url % (api_host, bookId, safe_username, api_key)
+                                logUrl=url.split("?")[0]
+                                logging.info("Retrieving metadata for \""+book["title"]+"\" with url "+logUrl)
+                                pending.append((bookId, urllib2.Request(url, headers=password_header)))
+                                pendingIds.add(bookId)
+
+                        # fetch data, concurrently if a worker pool is configured
+                        if pool != None:
+                            fetched = pool.imap(fetch, pending)
                         else:
-                            url=detail_url % (api_host, bookId, safe_username, api_key)
-                            logUrl=url.split("?")[0]
-                            logging.info("Retrieving metadata for \""+book["title"]+"\" with url "+logUrl)
-                            req=urllib2.Request(url, headers=password_header)
-
-                            # fetch data
-                            tempResult = fetchBookData(req)
-                            # store only if we got one
+                            fetched = (fetch(item) for item in pending)
+
+                        for (bookId, bookReq), tempResult in izip(pending, fetched):
+                            # pass on only if we got one
                             if tempResult != None:
                                 tempResult["locator"]="http://www.bookshare.org/browse/book/"+str(bookId)
-                                result[bookId] = tempResult
-
-                    print("Processed page %d of %d for category %s." % (page, numPages, category))
-                    logging.info("Finished fetching page %d of %d for category %s." % (page, numPages, category))
-
-                    # set to next page
-                    if page < numPages:
-                        page = page + 1
-                    else:
-                        page = 0
-
-                except ValueError:
-                    print "JSON failure"
-                    res = None
-                    retry = retry + 1
-                except KeyError:
-                    print "JSON failure"
-                    res = None
-                    retry = retry + 1
-                except urllib2.HTTPError as httpError:
-                    logging.info("Bookshare API responded with " + str(httpError.code) + " " + httpError.msg + ". Going to retry.")
-                    httpError.close()
-                    retry = retry + 1
-    return result
+                                seen.add(bookId)
+                                fetchedIds.append(bookId)
+                                yield bookId, tempResult
+
+                        print("Processed page %d of %d for category %s." % (page, numPages, category))
+                        logging.info("Finished fetching page %d of %d for category %s." % (page, numPages, category))
+
+                        # set to next page
+                        if page < numPages:
+                            page = page + 1
+                        else:
+                            page = 0
+
+                        if onPage != None:
+                            if page > 0:
+                                onPage(CrawlPosition(category, page, fetchedIds))
+                                fetchedIds = []
+                            elif category != CATEGORIES[-1]:
+                                onPage(CrawlPosition(CATEGORIES[CATEGORIES.index(category) + 1], 1, fetchedIds))
+                                fetchedIds = []
+
+                    except ValueError:
+                        print "JSON failure"
+                        res = None
+                        retry = retry + 1
+                    except KeyError:
+                        print "JSON failure"
+                        res = None
+                        retry = retry + 1
+                    except urllib2.HTTPError as httpError:
+                        logging.info("Bookshare API responded with " + str(httpError.code) + " " + httpError.msg + ". Going to retry.")
+                        httpError.close()
+                        retry = retry + 1
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+        if cache != None:
+            cache.flush()
+
+def fetchBookData(req, connections, cache=None, bookId=None):
+    cached = None
+    if cache != None:
+        cached = cache.get(bookId)
+        if cached != None:
+            if cache.isFresh(cached):
+                logging.debug("Using cached metadata for book " + str(bookId))
+                return cached.data
+            if cached.etag != None:
+                req.add_header("If-None-Match", cached.etag)
+            if cached.lastModified != None:
+                req.add_header("If-Modified-Since", cached.lastModified)
 
-def fetchBookData(req):
     bookResponse = None
     retry = 0
     while bookResponse == None and retry < 3:
         try:
-            conn = urllib2.urlopen(req)
+            conn = connections.urlopen(req)
             bookResponse=json.loads(conn.read())
             conn.close()
             data=bookResponse["bookshare"]["book"]["metadata"]
             logging.debug("book data:\n"+str(data))
             logging.debug("Making envelopes from this book's metadata. Categories: "+str(data["category"]))
+            if cache != None:
+                cache.put(bookId, data, etag=conn.info().getheader("ETag"), lastModified=conn.info().getheader("Last-Modified"))
             return data
         except urllib2.HTTPError as httpError :
+            if httpError.code == 304 and cached != None:
+                httpError.close()
+                logging.debug("Cached metadata for book " + str(bookId) + " is still current")
+                cache.touch(bookId)
+                return cached.data
             logging.info("API Server responded with " + str(httpError.code) + " " + httpError.msg + ". Going to retry.")
             httpError.close()
             retry = retry + 1
@@ -141,132 +579,381 @@ def getSigner(config):
     passPhrase = config.get('GPG', 'key_passphrase')
     keyLocations = [config.get('GPG', 'public_key_url'),]
     gpgBin = config.get('GPG', 'path')
-    return LRSignature.sign.Sign.Sign_0_21(privateKeyID=fingerprint, passphrase=passPhrase, publicKeyLocations=keyLocations, gpgbin=gpgBin)
+    backend = LRSignature.sign.Sign.BACKEND_GNUPG
+    secretKeyFile = None
+    if config.has_option('GPG', 'backend') and len(config.get('GPG', 'backend').strip()) > 0:
+        backend = config.get('GPG', 'backend').strip()
+    if config.has_option('GPG', 'secret_key_file') and len(config.get('GPG', 'secret_key_file').strip()) > 0:
+        secretKeyFile = config.get('GPG', 'secret_key_file')
+    signer = LRSignature.sign.Sign.Sign_0_21(privateKeyID=fingerprint, passphrase=passPhrase, publicKeyLocations=keyLocations, gpgbin=gpgBin, backend=backend, secretKeyFile=secretKeyFile)
+    signer.register_constant(*SHARED_CONSTANTS)
+    return signer
+
+def getSignWorkers(config):
+    return getIntOption(config, 'GPG', 'sign_workers', 1)
 
 def pushMetadata(config, books):
     signer = getSigner(config)
+    index = getPublishIndex(config)
     documents = []
-    doc = {"documents": documents}
     for bookId in books.keys():
-        logging.debug(json.dumps(makeEnvelope(bookId, books[bookId], signer)))
-        documents.append(makeEnvelope(bookId, books[bookId], signer))
-        
-    #JSON-ify results
-    doc_json=json.dumps(doc)
-    
-    numBooks = len(documents)
-    if numBooks > 0:
-        publishUrl = "http://" + config.get('Learning Registry', 'lr_node') + "/publish"
-        username = config.get('Learning Registry', 'lr_username')
-        password = config.get('Learning Registry', 'lr_password')
-        publishRequest=urllib2.Request(publishUrl, headers={"Content-type": "application/json; charset=utf-8", "Authorization" : "Basic " + base64.b64encode(username + ":" + password)})
-
-        retry = 0
-        successes=0
-        publishResponse = None
-        while ((publishResponse == None) and retry < 3):
-            logging.info("Publishing data to LR node at " + publishUrl + ", attempt " + str(retry + 1))
-            try:
-                conn = urllib2.urlopen(publishRequest, data=doc_json)
-                publishResponse = json.loads(conn.read())
-                conn.close()
-                if publishResponse["OK"] == False:
-                    logging.info("Publish failed, retrying")
-                    publishResponse = None
-                    retry = retry + 1
-                else:
-                    for result in publishResponse["document_results"]:
-                        if not result["OK"]:
-                            logging.error("Error in envelope: " + str(result["error"]))
-                        else:
-                            logging.info("Published document " + result["doc_ID"])
-                            successes+=1
-            except urllib2.HTTPError as httpError:
-                logging.info("LR Node responded with " + str(httpError.code) + " " + httpError.msg + ". Going to retry.")
-                httpError.close()
-                retry = retry + 1
-            except ValueError:
-                logging.info("Bad JSON response on publish attempt. Retrying.")
-                httpError.close()
-                retry = retry + 1
-        logging.info("Job completed, Found "+str(numBooks)+" books to upload. Uploaded "+str(successes)+" of "+str(numBooks)+" records successfully.")
+        payload = mapper_jsonLD(bookId, books[bookId])
+        if index.isCurrent(books[bookId]["locator"], contentHash(payload)):
+            logging.info("Metadata for " + books[bookId]["locator"] + " is unchanged since it was last published. Skipping.")
+            continue
+        documents.append(buildEnvelope(bookId, books[bookId], payload))
+    documents = signer.sign_many(documents, workers=getSignWorkers(config))
+    logEnvelopes(documents)
+    return publishEnvelopes(config, documents)
+
+def logEnvelopes(envelopes):
+    # serializing every envelope is only worth it when someone reads the debug log
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for envelope in envelopes:
+            logging.debug(json.dumps(envelope))
+
+def _publishBatch(config, documents, batcher=None):
+    # sends one batch, retrying the whole of it while the node refuses it.
+    # A batch that times out is dead-lettered rather than sent again, as the
+    # node may have taken it. Returns whether the node took (or may have
+    # taken) the batch and the (envelope, document result) pairs it answered with.
+    global gzipRefused
+    publishUrl = "http://" + config.get('Learning Registry', 'lr_node') + "/publish"
+    username = config.get('Learning Registry', 'lr_username')
+    password = config.get('Learning Registry', 'lr_password')
+    headers = {"Content-type": "application/json; charset=utf-8", "Authorization" : "Basic " + base64.b64encode(username + ":" + password)}
+
+    #JSON-ify results, compressed as it is encoded if the node takes gzip
+    compressed = getPublishGzip(config)
+    if compressed:
+        doc_json = gzipDocuments(documents)
     else:
+        doc_json = json.dumps({"documents": documents})
+
+    retry = 0
+    publishResponse = None
+    while ((publishResponse == None) and retry < 3):
+        logging.info("Publishing data to LR node at " + publishUrl + ", attempt " + str(retry + 1))
+        publishRequest = urllib2.Request(publishUrl, headers=headers)
+        if compressed:
+            publishRequest.add_header("Content-Encoding", "gzip")
+        try:
+            started = time.time()
+            conn = getConnectionPool(config).urlopen(publishRequest, data=doc_json, timeout=getIntOption(config, 'Main', 'publish_timeout', 300))
+            publishResponse = json.loads(conn.read())
+            conn.close()
+            if publishResponse["OK"] == False and compressed and refusesGzip(error=publishResponse.get("error")):
+                # the node could not read the gzip body, send it as is
+                logging.info("LR Node did not accept a gzip compressed batch. Publishing uncompressed.")
+                gzipRefused = True
+                compressed = False
+                doc_json = json.dumps({"documents": documents})
+                publishResponse = None
+            elif publishResponse["OK"] == False:
+                logging.info("Publish failed, retrying")
+                publishResponse = None
+                retry = retry + 1
+            elif batcher != None:
+                batcher.succeeded(time.time() - started)
+        except urllib2.HTTPError as httpError:
+            logging.info("LR Node responded with " + str(httpError.code) + " " + httpError.msg + ". Going to retry.")
+            httpError.close()
+            if compressed and refusesGzip(code=httpError.code):
+                logging.info("LR Node did not accept a gzip compressed batch. Publishing uncompressed.")
+                gzipRefused = True
+                compressed = False
+                doc_json = json.dumps({"documents": documents})
+                continue
+            if batcher != None and (httpError.code == 413 or httpError.code >= 500):
+                batcher.failed()
+            if httpError.code == 413 and len(documents) > 1:
+                # the same batch would be refused again, send it in halves
+                half = len(documents) / 2
+                firstAccepted, firstResults = _publishBatch(config, documents[:half], batcher)
+                secondAccepted, secondResults = _publishBatch(config, documents[half:], batcher)
+                return firstAccepted and secondAccepted, firstResults + secondResults
+            retry = retry + 1
+        except socket.timeout:
+            # the node may still take the batch, so sending it again could
+            # publish every envelope twice; leave it to a replay instead
+            logging.info("LR Node timed out. Not sending the batch again.")
+            if batcher != None:
+                batcher.failed()
+            writeDeadLetters(config, [(envelope, "timed out") for envelope in documents])
+            return True, []
+        except ValueError:
+            logging.info("Bad JSON response on publish attempt. Retrying.")
+            retry = retry + 1
+
+    if publishResponse == None:
+        return False, []
+    return True, zip(documents, publishResponse["document_results"])
+
+def writeDeadLetters(config, failed):
+    # envelopes the node kept rejecting, one JSON object per line, for
+    # replayDeadLetters to try again later
+    path = getOption(config, 'Main', 'dead_letter_path', 'lr_export.deadletter')
+    with open(path, "a") as deadLetters:
+        for envelope, error in failed:
+            deadLetters.write(json.dumps({"envelope": envelope, "error": error, "failed": datetime.datetime.now().strftime(STATE_DATE)}))
+            deadLetters.write("\n")
+    logging.error("Gave up on " + str(len(failed)) + " envelopes, written to " + path)
+
+def publishEnvelopes(config, documents, batcher=None):
+    # batcher, if given, is told how the node coped with each batch.
+    # Envelopes the node rejects are sent again, on their own, up to
+    # publish_retries times; the ones it still rejects go to the dead letter file.
+    successes=0
+    numBooks = len(documents)
+    if numBooks == 0:
         logging.info("No envelopes created, nothing to upload. Job completed.")
+        return True, 0
+
+    retries = getIntOption(config, 'Main', 'publish_retries', 3)
+    delay = getIntOption(config, 'Main', 'publish_retry_delay', 5)
+    index = getPublishIndex(config)
+    accepted = True
+    pending = documents
+    for attempt in range(retries + 1):
+        batchAccepted, results = _publishBatch(config, pending, batcher)
+        # accepted is False only if the node never took (part of) the batch
+        accepted = accepted and batchAccepted
+        failed = []
+        for envelope, result in results:
+            if not result["OK"]:
+                logging.error("Error in envelope: " + str(result.get("error")))
+                failed.append((envelope, result.get("error")))
+            else:
+                logging.info("Published document " + result["doc_ID"])
+                index.record(envelope["resource_locator"], contentHash(envelope["resource_data"]), result["doc_ID"])
+                successes+=1
+        if len(failed) == 0:
+            break
+        if attempt == retries:
+            writeDeadLetters(config, failed)
+            break
+        logging.info("Retrying " + str(len(failed)) + " rejected envelopes in " + str(delay * 2 ** attempt) + " seconds.")
+        time.sleep(delay * 2 ** attempt)
+        pending = [envelope for envelope, error in failed]
+    logging.info("Job completed, Found "+str(numBooks)+" books to upload. Uploaded "+str(successes)+" of "+str(numBooks)+" records successfully.")
+    return accepted, successes
+
+def replayDeadLetters(config):
+    # publishes the envelopes of the dead letter file again; the ones still
+    # rejected end up in a new dead letter file
+    path = getOption(config, 'Main', 'dead_letter_path', 'lr_export.deadletter')
+    replaying = path + ".replaying"
+    # a replay that was interrupted leaves its file behind; it is replayed
+    # again, together with anything dead-lettered since
+    if os.path.exists(path):
+        if os.path.exists(replaying):
+            with open(replaying, "a") as merged:
+                with open(path) as deadLetters:
+                    shutil.copyfileobj(deadLetters, merged)
+            os.remove(path)
+        else:
+            os.rename(path, replaying)
+    if not os.path.exists(replaying):
+        return 0, 0
+    index = getPublishIndex(config)
+    with open(replaying) as deadLetters:
+        envelopes = [json.loads(line)["envelope"] for line in deadLetters if len(line.strip()) > 0]
+    # skip what an interrupted replay already got onto the node
+    envelopes = [envelope for envelope in envelopes if not index.isCurrent(envelope["resource_locator"], contentHash(envelope["resource_data"]))]
+    batcher = getPublishBatcher(config)
+    successes = 0
+    for batch in batcher.batches(envelopes):
+        accepted, batchSuccesses = publishEnvelopes(config, batch, batcher)
+        successes += batchSuccesses
+        if not accepted:
+            # keep what was not even delivered for the next replay
+            undelivered = [envelope for envelope in batch if not index.isCurrent(envelope["resource_locator"], contentHash(envelope["resource_data"]))]
+            writeDeadLetters(config, [(envelope, "not delivered") for envelope in undelivered])
+    os.remove(replaying)
+    return len(envelopes), successes
+
+def _startStage(target, outQueue, errors):
+    # runs one pipeline stage in its own thread; downstream always gets an
+    # END_OF_STREAM marker, even when the stage fails
+    def run():
+        try:
+            target()
+        except Exception as e:
+            logging.exception("Pipeline stage failed")
+            errors.append(e)
+        finally:
+            outQueue.put(END_OF_STREAM)
+    stage = threading.Thread(target=run)
+    stage.setDaemon(True)
+    stage.start()
+    return stage
 
-def makeEnvelope(bookId, data, signer):
-    payload=mapper_jsonLD(bookId, data)
+def _drain(queue):
+    while True:
+        item = queue.get()
+        if item is END_OF_STREAM:
+            break
+        yield item
+
+class ExportResult(object):
+    def __init__(self, books, published, unchanged, complete):
+        self.books = books
+        self.published = published
+        self.unchanged = unchanged
+        # False if some batch never made it to the node
+        self.complete = complete
+
+def exportBooks(config, run, resumeFrom=None):
+    # fetch -> map/sign -> publish, each book flowing through as soon as it is
+    # fetched. The bounded queues between stages keep memory constant: a slow
+    # node or signer throttles the crawl instead of letting books pile up.
+    #
+    # The fetch stage also sends a CrawlPosition down the pipeline after each
+    # search page. It is saved as the checkpoint only once every book before it
+    # has been published, and the checkpoint is cleared when the run completes.
+    batchSize = int(config.get('Main', 'publish_batch_size'))
+    queueSize = getIntOption(config, 'Main', 'queue_size', batchSize * 2)
+    signer = getSigner(config)
+    signWorkers = getSignWorkers(config)
+
+    index = getPublishIndex(config)
+    checkpoint = getCrawlCheckpoint(config)
+
+    bookQueue = Queue.Queue(queueSize)
+    envelopeQueue = Queue.Queue(queueSize)
+    errors = []
+    counts = {"unchanged": 0}
+
+    def fetchStage():
+        for bookId, data in iterBooks(config, run.sinceDates, resumeFrom, onPage=bookQueue.put):
+            bookQueue.put((bookId, data))
+
+    def signPending(pending):
+        signed = signer.sign_many(pending, workers=signWorkers)
+        logEnvelopes(signed)
+        for envelope in signed:
+            envelopeQueue.put(envelope)
+        del pending[:]
+
+    def envelopeStage():
+        # signs whatever books are waiting, up to a publish batch at a time,
+        # so several gpg processes can run without holding books back
+        pending = []
+        for item in _drain(bookQueue):
+            if isinstance(item, CrawlPosition):
+                signPending(pending)
+                envelopeQueue.put(item)
+                continue
+            bookId, data = item
+            payload = mapper_jsonLD(bookId, data)
+            if index.isCurrent(data["locator"], contentHash(payload)):
+                # already on the node, don't spend a signature on it
+                logging.info("Metadata for " + data["locator"] + " is unchanged since it was last published. Skipping.")
+                counts["unchanged"] += 1
+            else:
+                pending.append(buildEnvelope(bookId, data, payload))
+            if len(pending) >= batchSize or (len(pending) > 0 and bookQueue.empty()):
+                signPending(pending)
+        signPending(pending)
+
+    stages = [_startStage(fetchStage, bookQueue, errors), _startStage(envelopeStage, envelopeQueue, errors)]
+
+    # do in batches
+    numBooks = 0
+    successes = 0
+    batcher = getPublishBatcher(config)
+    position = None
+    # ids fetched up to position that no saved checkpoint holds yet
+    unsavedIds = []
+    published = True
+
+    def savePosition():
+        checkpoint.save(run, CrawlPosition(position.category, position.page, unsavedIds))
+        del unsavedIds[:]
+
+    for item in _drain(envelopeQueue):
+        if isinstance(item, CrawlPosition):
+            position = item
+            unsavedIds.extend(position.fetchedIds)
+            if len(batcher) == 0 and published:
+                savePosition()
+            continue
+        numBooks += 1
+        for batch in batcher.add(item):
+            accepted, batchSuccesses = publishEnvelopes(config, batch, batcher)
+            successes += batchSuccesses
+            # once a batch is lost, the checkpoint must not move past it
+            published = published and accepted
+            # a position only counts once nothing before it is pending
+            if published and position != None and len(batcher) == 0:
+                savePosition()
+
+    # push any leftovers
+    accepted, batchSuccesses = publishEnvelopes(config, batcher.flush(), batcher)
+    successes += batchSuccesses
+    published = published and accepted
+    # even if a stage failed, everything before the last position is out now
+    if published and position != None:
+        savePosition()
+
+    # a failed stage may leave the one upstream of it blocked on a full queue
+    if len(errors) > 0:
+        raise errors[0]
+    for stage in stages:
+        stage.join()
+    if published:
+        checkpoint.clear()
+    return ExportResult(numBooks + counts["unchanged"], successes, counts["unchanged"], published)
+
+def makeEnvelope(bookId, data, signer, payload=None):
+    envelope = buildEnvelope(bookId, data, payload)
+
+    # sign envelope
+    signer.sign(envelope)
+    return envelope
+
+def buildEnvelope(bookId, data, payload=None):
+    # the unsigned envelope
+    if payload == None:
+        payload=mapper_jsonLD(bookId, data)
     #json of envelope to be written, in python form; each book goes into one of these:
     envelope={
         "doc_type": "resource_data", 
         "doc_version": "0.49.0",
         "active": True,
-        "TOS": {"submission_TOS": "http://www.learningregistry.org/tos/cc0/v0-5/"},
-        "identity": {
-            "submitter": "Bookshare.org",
-            "signer": "Bookshare.org",
-            "submitter_type": "agent"
-        },
+        "TOS": ENVELOPE_TOS,
+        "identity": ENVELOPE_IDENTITY,
         "resource_locator": data["locator"],
         "keys": ["accessible", "daisy", "bookshare"],
         "resource_data_type": "metadata",
         "payload_placement": "inline",
-        "payload_schema": ["json", "json-ld", "schema.org", "lrmi"],
+        "payload_schema": ENVELOPE_PAYLOAD_SCHEMA,
         "resource_data": payload
     }
 
     #add info to keys list:
     for cat in data["category"]: envelope["keys"].append(cat)
 
-    # sign envelope
-    signer.sign(envelope)
     return envelope
 
 def mapper_jsonLD(bookId, data):
     #maps Bookshare json data ("data") to JSON-LD
 
     payload = {
-        "@context": {
-            "@vocab": "http://schema.org/",
-            "lrmi": "http://lrmi.net/the-specification#",
-            "useRightsUrl": {
-                "@id": "lrmi:useRightsUrl",
-                "@type": "@id"
-            }
-        },
+        "@context": JSONLD_CONTEXT,
         "@type" : "http://schema.org/Book",
         "@id": data["locator"],
         "url": data["locator"],
         "name": data["title"],
         "bookFormat": "EBook/DAISY3",
         "useRightsUrl": "http://www.bookshare.org/_/aboutUs/legalInformation",
-        "provider": {
-            "@type": "http://schema.org/Organization",
-            "name": "Bookshare.org"
-        },
+        "provider": JSONLD_PROVIDER,
         "interactivityType": "expositive",
         "learningResourceType": "textbook",
-        "audience": {
-            "@type": "http://schema.org/EducationalAudience",
-            "educationalRole": "student"
-        },
-        "accessibilityFeature": [
-            "displayTransformability/font-size",
-            "displayTransformability/font-family",
-            "displayTransformability/color",
-            "displayTransformability/background-color",
-            "bookmarks",
-            "readingOrder",
-            "structuralNavigation"
-        ],
-        "accessibilityHazard": [
-            "noFlashingHazard",
-            "noMotionSimulationHazard",
-            "noSoundHazard"
-        ],
-        "accessibilityControl": [
-            "fullKeyboardControl",
-            "fullMouseControl"
-        ]
+        "audience": JSONLD_AUDIENCE,
+        "accessibilityFeature": JSONLD_ACCESSIBILITY_FEATURE,
+        "accessibilityHazard": JSONLD_ACCESSIBILITY_HAZARD,
+        "accessibilityControl": JSONLD_ACCESSIBILITY_CONTROL
     }
 
     # authors
@@ -306,23 +993,34 @@ def mapper_jsonLD(bookId, data):
 
 if __name__ == "__main__":
     config = readConfig()
-    lastRunDate = getLastRunDate(config)
+    if "--replay-dead-letters" in sys.argv[1:]:
+        initLogging(config)
+        replayed, published = replayDeadLetters(config)
+        print("Replayed %d dead letter envelopes, published %d" % (replayed, published))
+        sys.exit(0)
+    runState = getRunState(config)
+    runId, resumeFrom = getCrawlCheckpoint(config).load()
+    run = None
+    if runId != None:
+        # an interrupted run keeps its own start dates, its books are not all published yet
+        run = runState.resumeRun(runId)
+    if run == None:
+        resumeFrom = None
+        run = runState.startRun(getLastRunDates(config))
     initLogging(config)
-    print("Searching for new books since %s..." % (lastRunDate.strftime(LOG_DATE_FORMAT),))
-    books = fetchBooks(config, lastRunDate)
-    print("Found data for %d books" % (len(books),))
-
-    # do in batches
-    batchSize = int(config.get('Main', 'publish_batch_size'))
-    bookBatch = {}
-    for bookId in books.keys():
-        bookBatch[bookId] = books[bookId]
-        if (len(bookBatch) == batchSize):
-            pushMetadata(config, bookBatch)
-            bookBatch = {}
-
-    # push any leftovers
-    pushMetadata(config, bookBatch)
+    if resumeFrom != None:
+        print("Resuming interrupted run at page %d of category %s..." % (resumeFrom.page, resumeFrom.category))
+        logging.info("Resuming interrupted run at page %d of category %s." % (resumeFrom.page, resumeFrom.category))
+    print("Searching for new books since %s..." % (min(run.sinceDates.values()).strftime(LOG_DATE_FORMAT),))
+    try:
+        result = exportBooks(config, run, resumeFrom)
+    except:
+        runState.finishRun(run, "failed")
+        raise
+    if result.complete:
+        runState.finishRun(run, "completed", result)
+    else:
+        runState.finishRun(run, "incomplete", result)
+    print("Found data for %d books, published %d, %d unchanged" % (result.books, result.published, result.unchanged))
 
     print("Done.")
-
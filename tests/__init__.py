@@ -0,0 +1,3 @@
+import exporting
+
+__all__ = ["exporting"]
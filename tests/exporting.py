@@ -0,0 +1,440 @@
+'''
+Unit tests for lr_export. Run from the top of the repository:
+
+    python -m unittest tests.exporting
+'''
+import unittest, ConfigParser, datetime, json, logging, gzip, threading, BaseHTTPServer, SocketServer, os, shutil, tempfile, time, socket, httplib, urllib, urllib2
+from cStringIO import StringIO
+import lr_export
+
+
+class CountingSigner(object):
+    '''Stands in for Sign_0_21 and counts how often an envelope gets signed'''
+    def __init__(self):
+        self.signed = 0
+
+    def sign(self, envelope):
+        self.signed += 1
+        envelope["digital_signature"] = {"signature": "signature-{0}".format(self.signed)}
+        return envelope
+
+    def sign_many(self, envelopes, workers=1):
+        return [self.sign(envelope) for envelope in envelopes]
+
+
+class BookshareStub(object):
+    '''Stands in for the connection pool, answering search and detail requests
+    like Bookshare. pages maps each category to its search pages, each a list of
+    book ids. Detail records of the ids in slow take longer, and carry an ETag
+    that changes with their version in versions.'''
+    def __init__(self, pages, slow=[]):
+        self.pages = pages
+        self.slow = slow
+        self.versions = {}
+        self.interruptAt = None
+        self.details = []
+        self.revalidated = []
+        self.lock = threading.Lock()
+
+    def response(self, url, body, headers=""):
+        return urllib.addinfourl(StringIO(json.dumps(body)), httplib.HTTPMessage(StringIO(headers)), url, 200)
+
+    def urlopen(self, req, data=None, timeout=None):
+        url = req.get_full_url()
+        path = url.split("?")[0].split("/")
+        if path[4] == "search":
+            category = urllib.unquote(path[6])
+            page = int(path[12])
+            if self.interruptAt == (category, page):
+                self.interruptAt = None
+                raise socket.error("connection reset")
+            results = [{"id": bookId, "title": "Book {0}".format(bookId)} for bookId in self.pages[category][page - 1]]
+            return self.response(url, {"bookshare": {"book": {"list": {"numPages": len(self.pages[category]), "result": results}}}})
+        bookId = int(path[5])
+        version = self.versions.get(bookId, 1)
+        etag = '"{0}-{1}"'.format(bookId, version)
+        self.lock.acquire()
+        try:
+            self.details.append(bookId)
+        finally:
+            self.lock.release()
+        if req.get_header("If-none-match") == etag:
+            self.revalidated.append(bookId)
+            raise urllib2.HTTPError(url, 304, "Not Modified", httplib.HTTPMessage(StringIO("")), StringIO(""))
+        if bookId in self.slow:
+            time.sleep(0.2)
+        metadata = {"title": "Book {0} version {1}".format(bookId, version), "category": ["Textbooks"]}
+        return self.response(url, {"bookshare": {"book": {"metadata": metadata}}}, "ETag: {0}\r\n\r\n".format(etag))
+
+
+class Test(unittest.TestCase):
+    '''Unit tests for building, signing and publishing envelopes'''
+
+    def setUp(self):
+        self.config = ConfigParser.SafeConfigParser()
+        self.config.add_section("Main")
+        self.config.set("Main", "publish_batch_size", "2")
+
+        self.signer = CountingSigner()
+        self.published = []
+        self.batches = []
+
+        self.origGetSigner = lr_export.getSigner
+        self.origPublishEnvelopes = lr_export.publishEnvelopes
+        self.origIterBooks = lr_export.iterBooks
+        self.origStateDb = lr_export.stateDb
+        self.origConnectionPool = lr_export.connectionPool
+
+        lr_export.getSigner = lambda config: self.signer
+        lr_export.publishEnvelopes = self.publishEnvelopes
+        lr_export.iterBooks = lambda config, sinceDates, resumeFrom=None, onPage=None: iter(sorted(self.books.items()))
+        lr_export.stateDb = lr_export.StateDb(":memory:")
+
+        self.books = {}
+        for bookId in range(5):
+            self.books[bookId] = {
+                "locator": "http://www.bookshare.org/browse/book/{0}".format(bookId),
+                "title": "Book {0}".format(bookId),
+                "category": ["Textbooks"]
+            }
+
+        self.rootLevel = logging.getLogger().level
+
+    def tearDown(self):
+        lr_export.getSigner = self.origGetSigner
+        lr_export.publishEnvelopes = self.origPublishEnvelopes
+        lr_export.iterBooks = self.origIterBooks
+        lr_export.stateDb = self.origStateDb
+        lr_export.connectionPool = self.origConnectionPool
+        lr_export.gzipRefused = False
+        logging.getLogger().setLevel(self.rootLevel)
+
+    def publishEnvelopes(self, config, documents, batcher=None):
+        self.batches.append(len(documents))
+        self.published.extend(documents)
+        return True, len(documents)
+
+    def testPushMetadataSignsOnce(self):
+        '''Each envelope is signed exactly once'''
+        logging.getLogger().setLevel(logging.INFO)
+        lr_export.pushMetadata(self.config, self.books)
+
+        assert self.signer.signed == len(self.books), "expected one signature per book, got {0}".format(self.signer.signed)
+        assert len(self.published) == len(self.books), "not every envelope was published"
+
+    def testPushMetadataSignsOnceWithDebugLogging(self):
+        '''Debug logging serializes the signed envelopes instead of building new ones'''
+        logging.getLogger().setLevel(logging.DEBUG)
+        lr_export.pushMetadata(self.config, self.books)
+
+        assert self.signer.signed == len(self.books), "expected one signature per book, got {0}".format(self.signer.signed)
+        for envelope in self.published:
+            assert envelope.has_key("digital_signature"), "envelope published unsigned"
+
+    def testExportBooksSignsOnce(self):
+        '''The streaming pipeline signs each fetched book exactly once'''
+        run = lr_export.Run(1, datetime.datetime.now(), dict([(category, lr_export.DEFAULT_START_DATE) for category in lr_export.CATEGORIES]))
+        result = lr_export.exportBooks(self.config, run)
+
+        assert self.signer.signed == len(self.books), "expected one signature per book, got {0}".format(self.signer.signed)
+        assert result.books == len(self.books) and result.published == len(self.books)
+        assert [envelope["resource_locator"] for envelope in self.published] == [self.books[bookId]["locator"] for bookId in sorted(self.books.keys())], "envelopes published out of order"
+
+    def testExportBooksByteBudget(self):
+        '''With publish_batch_bytes, batches are packed by size instead of count'''
+        self.config.set("Main", "publish_batch_size", "50")
+        run = lr_export.Run(1, datetime.datetime.now(), dict([(category, lr_export.DEFAULT_START_DATE) for category in lr_export.CATEGORIES]))
+        self.books[0]["completeSynopsis"] = "x" * 8000
+        self.books[1]["completeSynopsis"] = "x" * 8000
+        self.config.set("Main", "publish_batch_bytes", "10000")
+        result = lr_export.exportBooks(self.config, run)
+
+        assert result.published == len(self.books), "not every envelope was published"
+        assert self.batches == [1, 1, 3], "unexpected batches {0}".format(self.batches)
+
+    def startBookshare(self, pages, slow=[]):
+        '''Points lr_export at a BookshareStub instead of the Bookshare API'''
+        bookshare = BookshareStub(pages, slow)
+        lr_export.connectionPool = bookshare
+        lr_export.iterBooks = self.origIterBooks
+        self.config.add_section("Bookshare")
+        self.config.set("Bookshare", "username", "user@example.org")
+        self.config.set("Bookshare", "password", "password")
+        self.config.set("Bookshare", "api_host", "api.bookshare.org")
+        self.config.set("Bookshare", "api_key", "key")
+        return bookshare
+
+    def testIterBooksFetchesConcurrently(self):
+        '''With fetch_workers, books still come out in search order, each fetched once'''
+        bookshare = self.startBookshare({"Educational Materials": [[2, 6, 6]], "Textbooks": [[1, 2, 3], [3, 4, 5]]}, slow=[1, 3])
+        self.config.set("Main", "fetch_workers", "3")
+        sinceDates = dict([(category, lr_export.DEFAULT_START_DATE) for category in lr_export.CATEGORIES])
+        books = list(lr_export.iterBooks(self.config, sinceDates))
+
+        assert [bookId for bookId, data in books] == [2, 6, 1, 3, 4, 5], "unexpected books {0}".format([bookId for bookId, data in books])
+        assert sorted(bookshare.details) == [1, 2, 3, 4, 5, 6], "books fetched more than once {0}".format(bookshare.details)
+        assert books[2][1]["locator"] == "http://www.bookshare.org/browse/book/1"
+
+    def testBookCacheRevalidates(self):
+        '''Fresh records are served from the cache; stale ones are revalidated with their ETag'''
+        bookshare = BookshareStub({})
+        request = lambda: urllib2.Request("https://api.bookshare.org/book/id/7/format/json/for/user?api_key=key")
+        cache = lr_export.BookCache(lr_export.stateDb, ttl=3600)
+        first = lr_export.fetchBookData(request(), bookshare, cache, 7)
+        assert lr_export.fetchBookData(request(), bookshare, cache, 7) == first
+        assert bookshare.details == [7], "fresh record fetched again"
+
+        cache.ttl = 0
+        assert lr_export.fetchBookData(request(), bookshare, cache, 7) == first
+        assert bookshare.revalidated == [7], "stale record not revalidated"
+
+        bookshare.versions[7] = 2
+        changed = lr_export.fetchBookData(request(), bookshare, cache, 7)
+        assert changed["title"] == "Book 7 version 2", "changed record not fetched"
+        assert cache.get(7).data == changed, "changed record not cached"
+
+    def testBookCacheEvictsLeastRecentlyUsed(self):
+        '''Beyond max_entries the least recently read records are evicted'''
+        cache = lr_export.BookCache(lr_export.stateDb, maxEntries=2)
+        for bookId in [1, 2]:
+            cache.put(bookId, {"title": "Book {0}".format(bookId)})
+            time.sleep(0.01)
+        assert cache.get(1) != None
+        time.sleep(0.01)
+        cache.put(3, {"title": "Book 3"})
+
+        assert cache.get(2) == None, "least recently used record kept"
+        assert cache.get(1) != None and cache.get(3) != None, "recently used record evicted"
+
+    def testExportBooksSkipsUnchanged(self):
+        '''Books published before are neither signed nor published again unless they changed'''
+        index = lr_export.getPublishIndex(self.config)
+        for bookId, data in self.books.items():
+            index.record(data["locator"], lr_export.contentHash(lr_export.mapper_jsonLD(bookId, data)), str(bookId))
+        self.books[2]["title"] = "Book 2, second edition"
+        run = lr_export.Run(1, datetime.datetime.now(), dict([(category, lr_export.DEFAULT_START_DATE) for category in lr_export.CATEGORIES]))
+        result = lr_export.exportBooks(self.config, run)
+
+        assert self.signer.signed == 1, "expected only the changed book signed, got {0}".format(self.signer.signed)
+        assert [envelope["resource_locator"] for envelope in self.published] == [self.books[2]["locator"]], "unchanged books published again"
+        assert result.unchanged == len(self.books) - 1
+
+    def testExportBooksResumes(self):
+        '''A run interrupted in the middle of a category resumes without publishing a book twice'''
+        bookshare = self.startBookshare({"Educational Materials": [[0, 1, 2], [3, 4], [5]], "Textbooks": [[2, 6]]})
+        bookshare.interruptAt = ("Educational Materials", 3)
+        run = lr_export.Run(1, datetime.datetime.now(), dict([(category, lr_export.DEFAULT_START_DATE) for category in lr_export.CATEGORIES]))
+        self.assertRaises(socket.error, lr_export.exportBooks, self.config, run)
+
+        runId, resumeFrom = lr_export.getCrawlCheckpoint(self.config).load()
+        assert runId == run.runId and (resumeFrom.category, resumeFrom.page) == ("Educational Materials", 3), "checkpoint not saved"
+        lr_export.exportBooks(self.config, run, resumeFrom)
+
+        locators = [envelope["resource_locator"] for envelope in self.published]
+        assert sorted(locators) == ["http://www.bookshare.org/browse/book/{0}".format(bookId) for bookId in range(7)], "unexpected books published {0}".format(locators)
+        assert lr_export.getCrawlCheckpoint(self.config).load() == (None, None), "checkpoint kept after the run completed"
+
+    def startNode(self, acceptsGzip, rejects={}, failures=[], delays=[]):
+        '''Stands in for a node's publish service, optionally refusing gzip bodies.
+        rejects maps resource locators to the number of times they are rejected;
+        the first requests fail as a whole with the errors in failures, and are
+        answered after the number of seconds in delays.'''
+        received = []
+        outer = self
+        self.requests = []
+        rejects = dict(rejects)
+        failures = list(failures)
+        delays = list(delays)
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                encoding = self.headers.get("Content-Encoding")
+                received.append(encoding)
+                if len(delays) > 0:
+                    time.sleep(delays.pop(0))
+                if encoding == "gzip" and not acceptsGzip:
+                    self.send_response(415)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if encoding == "gzip":
+                    body = gzip.GzipFile(fileobj=StringIO(body)).read()
+                documents = json.loads(body)["documents"]
+                locators = [document["resource_locator"] for document in documents]
+                outer.requests.append(locators)
+                if len(failures) > 0:
+                    response = json.dumps({"OK": False, "error": failures.pop(0)})
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(response)))
+                    self.end_headers()
+                    self.wfile.write(response)
+                    return
+                results = []
+                for idx, locator in enumerate(locators):
+                    if rejects.get(locator, 0) > 0:
+                        rejects[locator] -= 1
+                        results.append({"OK": False, "error": "rejected"})
+                    else:
+                        results.append({"OK": True, "doc_ID": str(idx)})
+                response = json.dumps({"OK": True, "document_results": results})
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        self.config.add_section("Learning Registry")
+        self.config.set("Learning Registry", "lr_node", "127.0.0.1:{0}".format(server.server_port))
+        self.config.set("Learning Registry", "lr_username", "user")
+        self.config.set("Learning Registry", "lr_password", "password")
+        self.config.set("Learning Registry", "publish_gzip", "true")
+        return received
+
+    def testPublishGzip(self):
+        '''Batches are sent gzip compressed when the node takes them'''
+        received = self.startNode(acceptsGzip=True)
+        documents = [lr_export.buildEnvelope(bookId, data) for bookId, data in self.books.items()]
+        accepted, successes = self.origPublishEnvelopes(self.config, documents)
+
+        assert accepted and successes == len(documents), "batch not published"
+        assert received == ["gzip"], "batch not sent compressed"
+
+    def testPublishGzipFallback(self):
+        '''A node refusing gzip gets the batch, and later ones, uncompressed'''
+        received = self.startNode(acceptsGzip=False)
+        documents = [lr_export.buildEnvelope(bookId, data) for bookId, data in self.books.items()]
+        accepted, successes = self.origPublishEnvelopes(self.config, documents[:2])
+        accepted, successes = self.origPublishEnvelopes(self.config, documents[2:])
+
+        assert accepted and successes == len(documents) - 2, "batch not published"
+        assert received == ["gzip", None, None], "unexpected encodings {0}".format(received)
+
+    def testPublishRetriesRejectedOnly(self):
+        '''Only rejected envelopes are sent again; the ones that keep failing are dead-lettered and can be replayed'''
+        locators = [self.books[bookId]["locator"] for bookId in sorted(self.books.keys())]
+        self.startNode(acceptsGzip=True, rejects={locators[1]: 1, locators[3]: 3})
+        self.config.set("Learning Registry", "publish_gzip", "false")
+        self.config.set("Main", "publish_retries", "2")
+        self.config.set("Main", "publish_retry_delay", "0")
+        deadLetterDir = tempfile.mkdtemp()
+        deadLetterPath = os.path.join(deadLetterDir, "lr_export.deadletter")
+        self.config.set("Main", "dead_letter_path", deadLetterPath)
+        try:
+            documents = [lr_export.buildEnvelope(bookId, self.books[bookId]) for bookId in sorted(self.books.keys())]
+            accepted, successes = self.origPublishEnvelopes(self.config, documents)
+
+            assert accepted and successes == len(documents) - 1, "unexpected successes {0}".format(successes)
+            assert self.requests == [locators, [locators[1], locators[3]], [locators[3]]], "accepted envelopes sent again"
+            with open(deadLetterPath) as deadLetters:
+                deadLettered = [json.loads(line) for line in deadLetters]
+            assert [entry["envelope"]["resource_locator"] for entry in deadLettered] == [locators[3]], "rejected envelope not dead-lettered"
+            assert deadLettered[0]["error"] == "rejected"
+
+            replayed, published = lr_export.replayDeadLetters(self.config)
+            assert replayed == 1 and published == 1, "dead letter not replayed"
+            assert not os.path.exists(deadLetterPath), "replayed envelope still dead-lettered"
+        finally:
+            shutil.rmtree(deadLetterDir, ignore_errors=True)
+
+    def testFailedFirstRunKeepsSinceDates(self):
+        '''A first run that fails does not make its own log file the next since-date'''
+        logDir = tempfile.mkdtemp()
+        self.config.set("Main", "log_path", logDir)
+        try:
+            oldLog = datetime.datetime(2010, 5, 1, 12, 0, 0)
+            open(os.path.join(logDir, oldLog.strftime(lr_export.LOG_FILENAME_FORMAT)), "w").close()
+            sinceDates = lr_export.getLastRunDates(self.config)
+            assert sinceDates == dict([(category, oldLog) for category in lr_export.CATEGORIES]), "log date of the old install not used"
+
+            runState = lr_export.getRunState(self.config)
+            run = runState.startRun(sinceDates)
+            open(os.path.join(logDir, datetime.datetime.now().strftime(lr_export.LOG_FILENAME_FORMAT)), "w").close()
+            runState.finishRun(run, "failed")
+
+            assert lr_export.getLastRunDates(self.config) == sinceDates, "failed run moved the since-dates"
+        finally:
+            shutil.rmtree(logDir, ignore_errors=True)
+
+    def testStateDbInMemory(self):
+        '''A state_path of :memory: keeps the state in memory instead of creating a file'''
+        workDir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(workDir)
+        try:
+            lr_export.stateDb = None
+            self.config.set("Main", "state_path", ":memory:")
+            lr_export.getRunState(self.config).startRun({})
+            assert os.listdir(workDir) == [], "state file created for :memory:"
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    def testReplayAfterInterruptedReplay(self):
+        '''Envelopes left behind by an interrupted replay are replayed with the new dead letters'''
+        locators = [self.books[bookId]["locator"] for bookId in sorted(self.books.keys())]
+        self.startNode(acceptsGzip=True)
+        lr_export.publishEnvelopes = self.origPublishEnvelopes
+        deadLetterDir = tempfile.mkdtemp()
+        deadLetterPath = os.path.join(deadLetterDir, "lr_export.deadletter")
+        self.config.set("Main", "dead_letter_path", deadLetterPath)
+        try:
+            documents = [lr_export.buildEnvelope(bookId, self.books[bookId]) for bookId in sorted(self.books.keys())]
+            # the interrupted replay had already published the first envelope of its file
+            lr_export.writeDeadLetters(self.config, [(documents[0], "rejected"), (documents[1], "rejected")])
+            os.rename(deadLetterPath, deadLetterPath + ".replaying")
+            lr_export.getPublishIndex(self.config).record(locators[0], lr_export.contentHash(documents[0]["resource_data"]), "0")
+            lr_export.writeDeadLetters(self.config, [(documents[2], "rejected")])
+
+            replayed, published = lr_export.replayDeadLetters(self.config)
+            assert replayed == 2 and published == 2, "unexpected replay {0}, {1}".format(replayed, published)
+            assert self.requests == [locators[1:3]], "unexpected envelopes replayed {0}".format(self.requests)
+            assert not os.path.exists(deadLetterPath) and not os.path.exists(deadLetterPath + ".replaying"), "dead letters left behind"
+            assert lr_export.replayDeadLetters(self.config) == (0, 0)
+        finally:
+            shutil.rmtree(deadLetterDir, ignore_errors=True)
+
+    def testPublishGzipKeptAfterFailedBatch(self):
+        '''A batch the node fails for other reasons does not turn compression off'''
+        received = self.startNode(acceptsGzip=True, failures=["validation failed"])
+        documents = [lr_export.buildEnvelope(bookId, data) for bookId, data in self.books.items()]
+        accepted, successes = self.origPublishEnvelopes(self.config, documents)
+
+        assert accepted and successes == len(documents), "batch not published"
+        assert received == ["gzip", "gzip"], "unexpected encodings {0}".format(received)
+        assert not lr_export.gzipRefused, "compression turned off"
+
+    def testPublishTimeoutShrinksBatches(self):
+        '''A batch the node does not answer within publish_timeout is dead-lettered, not sent twice, and the next batches are smaller'''
+        locators = [self.books[bookId]["locator"] for bookId in sorted(self.books.keys())]
+        self.startNode(acceptsGzip=True, delays=[2])
+        self.config.set("Main", "publish_timeout", "1")
+        self.config.set("Main", "publish_batch_bytes", "100000")
+        deadLetterDir = tempfile.mkdtemp()
+        deadLetterPath = os.path.join(deadLetterDir, "lr_export.deadletter")
+        self.config.set("Main", "dead_letter_path", deadLetterPath)
+        try:
+            batcher = lr_export.getPublishBatcher(self.config)
+            documents = [lr_export.buildEnvelope(bookId, self.books[bookId]) for bookId in sorted(self.books.keys())]
+            accepted, successes = self.origPublishEnvelopes(self.config, documents, batcher)
+
+            assert accepted and successes == 0, "unexpected successes {0}".format(successes)
+            assert batcher.target < 100000, "batch target not cut after a timeout"
+            time.sleep(1.5)
+            assert self.requests == [locators], "timed out batch sent again {0}".format(self.requests)
+            with open(deadLetterPath) as deadLetters:
+                deadLettered = [json.loads(line) for line in deadLetters]
+            assert [entry["envelope"]["resource_locator"] for entry in deadLettered] == locators, "timed out batch not dead-lettered"
+        finally:
+            shutil.rmtree(deadLetterDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()